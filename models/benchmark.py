@@ -0,0 +1,116 @@
+"""
+Throughput benchmarks on synthetic data.  Run as
+
+    python benchmark.py [svd|recommend]
+"""
+
+import sys
+import numpy as np
+from time import time
+from helper import IdMap, ReviewData
+from models import BiasSVD
+import kernels
+
+
+def synthetic(nreviews, nusers, nitems, seed=0):
+    """
+    ReviewData with random users/items and ratings from a rank-2 model
+    """
+    rng = np.random.RandomState(seed)
+    uid = rng.randint(0, nusers, nreviews).astype(np.int32)
+    aid = (rng.pareto(1.2, nreviews) * nitems / 10).astype(np.int64) % nitems
+    U = rng.normal(0, 0.5, [nusers, 2])
+    V = rng.normal(0, 0.5, [nitems, 2])
+    rating = 4 + (U[uid] * V[aid]).sum(1) + rng.normal(0, 0.5, nreviews)
+    zeros = np.zeros(nreviews, dtype=np.int32)
+    cols = {'rating': np.clip(np.round(rating), 1, 5).astype(np.float32),
+            'uid': uid, 'aid': aid.astype(np.int32),
+            'lang': zeros.astype(np.int16), 'country': zeros.astype(np.int16),
+            'location': zeros, 'date': zeros,
+            'year': zeros.astype(np.int16) + 2014,
+            'month': rng.randint(1, 13, nreviews).astype(np.int8),
+            'kgroup': np.zeros([nreviews, 0], dtype=np.int8)}
+    maps = dict((name, IdMap()) for name in ReviewData.map_names)
+    maps['uid'] = IdMap(range(nusers))
+    maps['aid'] = IdMap(range(nitems))
+    maps['lang'] = IdMap([None])
+    maps['country'] = IdMap([None])
+    maps['location'] = IdMap([None])
+    return ReviewData(cols, maps)
+
+
+def bench_svd(nreviews=200000, nusers=20000, nitems=2000, nfeats=10, python_reviews=20000):
+    """
+    Reviews per second of BiasSVD training for each backend, feature-wise
+    and joint.  The python backend runs on the first python_reviews only.
+    """
+    data = synthetic(nreviews, nusers, nitems)
+    small = data.take(np.arange(min(python_reviews, nreviews)))
+    print "BiasSVD training, {} features".format(nfeats)
+    for joint in [False, True]:
+        for backend in ['python', 'numba']:
+            if backend == 'numba' and kernels.COMPILED is None:
+                print "{:<8} {:<7} skipped, numba not installed".format(
+                    'joint' if joint else 'feature', backend)
+                continue
+            model = BiasSVD(nusers, nitems)
+            model.nfeats = nfeats
+            model.max_train_iters = 1
+            model.backend = backend
+            model.joint = joint
+            train = small if backend == 'python' else data
+            if backend == 'numba':
+                # compile outside the timed run
+                model.train(data.take(np.arange(100)))
+            t0 = time()
+            model.train(train)
+            elapsed = time() - t0
+            passes = 1 if joint else nfeats
+            print "{:<8} {:<7} {:>12,.0f} reviews/sec".format(
+                'joint' if joint else 'feature', backend, passes * len(train) / elapsed)
+
+
+def bench_recommend(nusers=20000, nitems=5000, nfeats=10, k=10, nqueries=2000):
+    """
+    Queries per second of BiasSVD.recommend, one user per call and in
+    batches of block_users, exact and through the approximate index,
+    plus the index's recall of the exact top k
+    """
+    rng = np.random.RandomState(0)
+    model = BiasSVD(nusers, nitems)
+    model.nfeats = nfeats
+    model.avg = 4.
+    model.U = rng.normal(0, 0.3, [nusers, nfeats])
+    model.V = rng.normal(0, 0.3, [nitems, nfeats])
+    model.ubias = rng.normal(0, 0.2, nusers)
+    model.abias = rng.normal(0, 0.2, nitems)
+    users = rng.randint(0, nusers, nqueries)
+    print "BiasSVD.recommend, {} items, {} features, top {}".format(nitems, nfeats, k)
+
+    t0 = time()
+    exact, _ = model.recommend(users, k, exclude_seen=False)
+    print "{:<16} {:>10,.0f} queries/sec".format('exact batched', nqueries / (time() - t0))
+    t0 = time()
+    for user in users[:200]:
+        model.recommend(user, k, exclude_seen=False)
+    print "{:<16} {:>10,.0f} queries/sec".format('exact single', 200 / (time() - t0))
+
+    t0 = time()
+    model.build_index()
+    print "index built in {:.2f}s, {} lists".format(time() - t0, len(model.index.centroids))
+    for nprobe in [4, 8, 16]:
+        model.index.nprobe = nprobe
+        t0 = time()
+        found, _ = model.recommend(users, k, exclude_seen=False, approx=True)
+        elapsed = time() - t0
+        recall = np.mean([len(set(a) & set(b)) / float(k) for a, b in zip(found, exact)])
+        print "{:<16} {:>10,.0f} queries/sec  recall {:.3f}".format(
+            'approx nprobe={}'.format(nprobe), nqueries / elapsed, recall)
+
+
+if __name__ == '__main__':
+    which = sys.argv[1:] or ['svd', 'recommend']
+    if 'svd' in which:
+        bench_svd()
+    if 'recommend' in which:
+        bench_recommend()
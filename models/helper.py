@@ -1,55 +1,731 @@
+import os
+import re
+import json
+import shutil
 import sqlite3
-from datetime import datetime
+import hashlib
+import numpy as np
+from datetime import date
 from dateutil.parser import parse
 
+EPOCH = date(1970, 1, 1).toordinal()
+
+MONTHS = dict((name, i+1) for i, name in enumerate(
+    ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+     'august', 'september', 'october', 'november', 'december']))
+MONTHS.update(dict((name[:3], i) for name, i in MONTHS.items()))
+MONTHS['sept'] = 9
+
+# (regex, order of the year/month/day groups) for the formats seen in the db
+DATE_FORMATS = [
+    (re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T].*)?$'), 'ymd'),
+    (re.compile(r'^([A-Za-z]+)\.? (\d{1,2}),? (\d{4})$'), 'mdy'),
+    (re.compile(r'^(\d{1,2}) ([A-Za-z]+)\.?,? (\d{4})$'), 'dmy'),
+    (re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$'), 'mdy'),
+]
+
+
+def decode_date(txt):
+    """
+    Decodes the known review_date formats without dateutil.
+    Returns a date or None if the string is not recognised.
+    """
+    txt = txt.strip()
+    for regex, order in DATE_FORMATS:
+        match = regex.match(txt)
+        if not match:
+            continue
+        fields = dict(zip(order, match.groups()))
+        month = fields['m']
+        if month.isdigit():
+            month = int(month)
+        else:
+            month = MONTHS.get(month.lower())
+        try:
+            return date(int(fields['y']), month, int(fields['d']))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+class DateDecoder(object):
+    """
+    Bulk review_date decoding.  Each distinct string is decoded once
+    (there are only a few thousand distinct dates), falling back to
+    dateutil for unrecognised formats.  fallbacks counts the distinct
+    strings that needed dateutil.
+    """
+    def __init__(self):
+        self.memo = {}
+        self.fallbacks = 0
+
+    def decode(self, txt):
+        day = decode_date(txt)
+        if day is None:
+            self.fallbacks += 1
+            day = parse(txt).date()
+        return day.toordinal() - EPOCH, day.year, day.month
+
+    def __call__(self, strings):
+        """
+        Returns (epoch days, year, month) arrays
+        """
+        memo = self.memo
+        for txt in set(strings):
+            if txt not in memo:
+                memo[txt] = self.decode(txt)
+        decoded = np.array([memo[txt] for txt in strings], dtype=np.int32).reshape(-1, 3)
+        return decoded[:, 0], decoded[:, 1].astype(np.int16), decoded[:, 2].astype(np.int8)
+
+
+def write_dir(dirname, arrays, docs):
+    """
+    Writes directory dirname holding each array in arrays as name.npy
+    and each object in docs as name.json.  It is written next to its
+    final location and renamed into place, replacing any older version,
+    so readers never see a partial directory.
+    """
+    tmpname = dirname + '.tmp{}'.format(os.getpid())
+    if os.path.exists(tmpname):
+        shutil.rmtree(tmpname)
+    os.makedirs(tmpname)
+    for name, value in arrays.iteritems():
+        np.save(os.path.join(tmpname, name + '.npy'), value)
+    for name, doc in docs.iteritems():
+        with open(os.path.join(tmpname, name + '.json'), 'w') as f:
+            json.dump(doc, f)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpname, dirname)
+
+
 class Review(object):
     def __init__(self, d):
         self.__dict__ = d
-    
+
     def __repr__(self):
         return "<OBJECT REVIEW>: uid:{} aid:{} rating:{}".format(self.uid, self.aid, self.rating)
 
+
+class IdMap(object):
+    """
+    Maps raw ids (uid, aid, lang, ...) to dense integer indices and back.
+    New ids are appended, so existing indices never change.
+    """
+    def __init__(self, keys=None):
+        self.keys = []
+        self.index = {}
+        if keys is not None:
+            for key in keys:
+                self.add(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key):
+        idx = self.index.get(key)
+        if idx is None:
+            idx = len(self.keys)
+            self.index[key] = idx
+            self.keys.append(key)
+        return idx
+
+    def get(self, key, default=-1):
+        return self.index.get(key, default)
+
+    def lookup(self, keys):
+        return np.array([self.index.get(k, -1) for k in keys], dtype=np.int64)
+
+
+class ReviewData(object):
+    """
+    Columnar form of the reviews table.  Every per-review field is a numpy
+    array of length nreviews; uid/aid/lang/country/location/tags are dense
+    indices into the IdMaps in self.maps.  kgroup is a (nreviews, ngroups)
+    matrix holding the 1-based cluster ids, 0 where the activity has none.
+    Tags are stored CSR style: the tags of review i are
+    tag_ids[tag_ptr[i]:tag_ptr[i+1]].
+
+    Iterating (or indexing with an int) yields Review objects so the
+    per-review models keep working unchanged.
+
+    view() returns a contiguous range of rows without copying; tag_ptr
+    then starts at an offset into the shared tag_ids.
+    """
+    columns = ['rating', 'uid', 'aid', 'lang', 'country', 'location',
+               'date', 'year', 'month', 'kgroup']
+    map_names = ['uid', 'aid', 'lang', 'country', 'location', 'tags']
+
+    def __init__(self, cols, maps, tag_ptr=None, tag_ids=None, meta=None):
+        self.maps = maps
+        # free-form json serializable info saved with the columns
+        self.meta = meta or {}
+        for name in self.columns:
+            setattr(self, name, cols[name])
+        n = len(self.rating)
+        if tag_ptr is None:
+            tag_ptr = np.zeros(n+1, dtype=np.int64)
+            tag_ids = np.zeros(0, dtype=np.int32)
+        self.tag_ptr = tag_ptr
+        self.tag_ids = tag_ids
+        self._stats = None
+        self._fingerprint = None
+
+    @property
+    def nusers(self):
+        return len(self.maps['uid'])
+
+    @property
+    def nitems(self):
+        return len(self.maps['aid'])
+
+    def __len__(self):
+        return len(self.rating)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.review(i)
+
+    def __getitem__(self, i):
+        return self.review(i)
+
+    def review(self, i):
+        """
+        Build a Review object for row i.  uid/aid hold the raw ids,
+        uidx/aidx the dense indices.
+        """
+        maps = self.maps
+        uidx = int(self.uid[i])
+        aidx = int(self.aid[i])
+        kgroup = [int(x) for x in self.kgroup[i]]
+        if not any(kgroup):
+            kgroup = None
+        tags = self.tag_ids[self.tag_ptr[i]:self.tag_ptr[i+1]]
+        d = {'uid': maps['uid'].keys[uidx],
+             'aid': maps['aid'].keys[aidx],
+             'uidx': uidx,
+             'aidx': aidx,
+             'rating': float(self.rating[i]),
+             'lang': maps['lang'].keys[self.lang[i]],
+             'country': maps['country'].keys[self.country[i]],
+             'location': maps['location'].keys[self.location[i]],
+             'review_date': date.fromordinal(int(self.date[i]) + EPOCH),
+             'month': int(self.month[i]),
+             'kgroup': kgroup,
+             'tags': [maps['tags'].keys[t] for t in tags]}
+        return Review(d)
+
+    def reviews(self):
+        """
+        List of the Review objects of every row, the same as list(self)
+        but built from whole columns at once
+        """
+        maps = self.maps
+        ukeys, akeys = maps['uid'].keys, maps['aid'].keys
+        lkeys, ckeys, lockeys = maps['lang'].keys, maps['country'].keys, maps['location'].keys
+        tkeys = maps['tags'].keys
+        days = dict((day, date.fromordinal(day + EPOCH)) for day in np.unique(self.date).tolist())
+        ptr = self.tag_ptr.tolist()
+        tag_ids = self.tag_ids.tolist()
+        kgroups = self.kgroup.tolist()
+        out = []
+        for i, (u, a, r, l, c, loc, day, month) in enumerate(zip(
+                self.uid.tolist(), self.aid.tolist(), self.rating.tolist(), self.lang.tolist(),
+                self.country.tolist(), self.location.tolist(), self.date.tolist(), self.month.tolist())):
+            kgroup = kgroups[i]
+            out.append(Review({'uid': ukeys[u], 'aid': akeys[a], 'uidx': u, 'aidx': a,
+                               'rating': r, 'lang': lkeys[l], 'country': ckeys[c],
+                               'location': lockeys[loc], 'review_date': days[day],
+                               'month': month, 'kgroup': kgroup if any(kgroup) else None,
+                               'tags': [tkeys[t] for t in tag_ids[ptr[i]:ptr[i+1]]]}))
+        return out
+
+    def view(self, start, stop):
+        """
+        Rows start:stop as a ReviewData sharing this one's memory
+        """
+        cols = dict((name, getattr(self, name)[start:stop]) for name in self.columns)
+        return ReviewData(cols, self.maps, self.tag_ptr[start:stop+1], self.tag_ids)
+
+    def stats(self):
+        """
+        Sufficient statistics shared by the models trained on this data,
+        computed on first use: nreviews, avg (mean rating) and the
+        per-user and per-item review counts
+        """
+        if self._stats is None:
+            self._stats = review_stats(self.rating, self.uid, self.aid, self.nusers, self.nitems)
+        return self._stats
+
+    def fingerprint(self):
+        """
+        sha1 hex digest of the reviews (every column, the tags and the id
+        maps), computed on first use.  Equal data gives equal digests
+        whether it was parsed, loaded from the cache or memory mapped.
+        """
+        if self._fingerprint is None:
+            sha = hashlib.sha1()
+            for name in self.columns:
+                col = np.ascontiguousarray(getattr(self, name))
+                sha.update('{}:{}:{}'.format(name, col.dtype.str, col.shape))
+                sha.update(col.view(np.uint8))
+            sha.update(np.ascontiguousarray(np.diff(self.tag_ptr)).view(np.uint8))
+            sha.update(np.ascontiguousarray(self.tag_ids[self.tag_ptr[0]:self.tag_ptr[-1]]).view(np.uint8))
+            for name in sorted(self.maps):
+                sha.update(json.dumps([name, self.maps[name].keys]))
+            self._fingerprint = sha.hexdigest()
+        return self._fingerprint
+
+    def take(self, idx):
+        """
+        Returns a new ReviewData holding the rows in idx.  The IdMaps are
+        shared, so dense indices stay valid across subsets.
+        """
+        idx = np.asarray(idx)
+        cols = dict((name, getattr(self, name)[idx]) for name in self.columns)
+        starts = self.tag_ptr[idx]
+        counts = self.tag_ptr[idx+1] - starts
+        tag_ptr = np.zeros(len(idx)+1, dtype=np.int64)
+        np.cumsum(counts, out=tag_ptr[1:])
+        if tag_ptr[-1]:
+            offsets = np.repeat(starts - tag_ptr[:-1], counts)
+            tag_ids = self.tag_ids[np.arange(tag_ptr[-1]) + offsets]
+        else:
+            tag_ids = np.zeros(0, dtype=np.int32)
+        return ReviewData(cols, self.maps, tag_ptr, tag_ids)
+
+    def save(self, dirname):
+        """
+        Writes every column as a .npy file plus the IdMaps as json (see
+        write_dir)
+        """
+        arrays = dict((name, getattr(self, name)) for name in self.columns + ['tag_ptr', 'tag_ids'])
+        maps = dict((name, m.keys) for name, m in self.maps.iteritems())
+        write_dir(dirname, arrays, {'maps': maps, 'meta': self.meta})
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        """
+        Loads a directory written by save().  With mmap_mode='r' the columns
+        are memory mapped, so processes loading the same cache share pages.
+        """
+        with open(os.path.join(dirname, 'maps.json')) as f:
+            maps = dict((name, IdMap(keys)) for name, keys in json.load(f).iteritems())
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        cols = {}
+        for name in cls.columns + ['tag_ptr', 'tag_ids']:
+            cols[name] = np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode)
+        return cls(cols, maps, cols.pop('tag_ptr'), cols.pop('tag_ids'), meta)
+
+    def extend(self, parts):
+        """
+        Returns a new ReviewData with the column chunks in parts appended
+        """
+        old = dict((name, getattr(self, name)) for name in self.columns)
+        old['ntags'] = np.diff(self.tag_ptr)
+        old['tag_ids'] = self.tag_ids[self.tag_ptr[0]:self.tag_ptr[-1]]
+        data = ReviewData.concat([old] + list(parts), self.maps)
+        data.meta = dict(self.meta)
+        return data
+
+    @classmethod
+    def concat(cls, parts, maps):
+        """
+        Joins column chunks (dicts as produced by Parse.parse_lines)
+        """
+        # early chunks may have seen fewer kgroup columns than later ones
+        ngroups = max(p['kgroup'].shape[1] for p in parts)
+        for p in parts:
+            width = p['kgroup'].shape[1]
+            if width < ngroups:
+                p['kgroup'] = np.pad(p['kgroup'], [(0, 0), (0, ngroups-width)], 'constant')
+
+        cols = {}
+        for name in cls.columns + ['ntags', 'tag_ids']:
+            cols[name] = np.concatenate([p[name] for p in parts])
+        tag_ptr = np.zeros(len(cols['rating'])+1, dtype=np.int64)
+        np.cumsum(cols.pop('ntags'), out=tag_ptr[1:])
+        tag_ids = cols.pop('tag_ids')
+        return cls(cols, maps, tag_ptr, tag_ids)
+
+
+def review_stats(rating, uid, aid, nusers, nitems):
+    """
+    The ReviewData.stats dict for the given rating/uid/aid columns
+    """
+    n = len(rating)
+    return {'nreviews': n,
+            'avg': float(rating.sum(dtype=np.float64) / n) if n else 0.,
+            'user_counts': np.bincount(uid, minlength=nusers),
+            'item_counts': np.bincount(aid, minlength=nitems)}
+
+
+class Folds(object):
+    """
+    K-fold split of a ReviewData with every fold a view of one layout.
+
+    The rows are shuffled once by a permutation; the test rows of fold k
+    are one contiguous range of it and its training rows the rest, in
+    the order that follows that range (wrapping around).  The layout is
+    the shuffled rows followed by the head of them again, just long
+    enough for the last fold's training range, so every train/test
+    subset is a view and evaluating more models copies no data.  It is
+    built once, on the first split or by ModelWrapper before forking,
+    so workers share it.  Fold membership matches sklearn's KFold with
+    the same seed, but the rows are in shuffled rather than sorted order.
+
+    indices(k) gives the folds as (train, test) index arrays into the
+    data; stats(k) the training statistics of fold k, computed from the
+    indices once and reused by every model evaluated on it.
+    """
+    def __init__(self, data, n_folds=5, seed=0):
+        n = len(data)
+        self.n = n
+        self.n_folds = n_folds
+        self.data = data
+        self.perm = np.random.RandomState(seed).permutation(n)
+        sizes = np.empty(n_folds, dtype=np.int64)
+        sizes.fill(n // n_folds)
+        sizes[:n % n_folds] += 1
+        self.bounds = np.concatenate([[0], np.cumsum(sizes)])
+        self.fold_stats = {}
+        self.layout = None
+        self.views = {}
+
+    def __len__(self):
+        return self.n_folds
+
+    def arrange(self):
+        """
+        The shuffled layout every fold is a view of, built on first use
+        """
+        if self.layout is None:
+            wrap = self.perm[:self.bounds[-2]]
+            self.layout = self.data.take(np.concatenate([self.perm, wrap]))
+        return self.layout
+
+    def split(self, k):
+        """
+        (train, test) ReviewData views of fold k
+        """
+        if k not in self.views:
+            layout = self.arrange()
+            start, stop = self.bounds[k], self.bounds[k+1]
+            train = layout.view(stop, start + self.n)
+            train._stats = self.stats(k)
+            self.views[k] = (train, layout.view(start, stop))
+        return self.views[k]
+
+    def indices(self, k):
+        start, stop = self.bounds[k], self.bounds[k+1]
+        return np.concatenate([self.perm[stop:], self.perm[:start]]), self.perm[start:stop]
+
+    def stats(self, k):
+        if k not in self.fold_stats:
+            train = self.indices(k)[0]
+            data = self.data
+            self.fold_stats[k] = review_stats(data.rating[train], data.uid[train], data.aid[train],
+                                              data.nusers, data.nitems)
+        return self.fold_stats[k]
+
+
+DEFAULT_FILTERS = {'exclude_countries': ['USA']}
+
+# filter name -> (column, negate) for the list valued filters
+LIST_FILTERS = {
+    'countries': ('reviews.country', False),
+    'exclude_countries': ('reviews.country', True),
+    'langs': ('reviews.lang', False),
+    'exclude_langs': ('reviews.lang', True),
+    'aids': ('reviews.aid', False),
+    'uids': ('reviews.uid', False),
+}
+# the other filter names compile_filters and Parse understand
+OTHER_FILTERS = set(['min_item_reviews', 'date_from', 'date_to'])
+
+
+def compile_filters(filters):
+    """
+    Turns a filter dict into SQL predicates on the reviews table.
+    Supported keys:
+        countries, exclude_countries, langs, exclude_langs, aids, uids:
+            lists of values.  None in an include list matches NULL;
+            like != the exclude lists always drop NULL values.
+        min_item_reviews: keep attractions with at least this many rated
+            reviews that pass the other SQL filters.  The date window is
+            not part of the count, since dates are only decoded after
+            the query, so with date_from/date_to an attraction can end up
+            with fewer reviews inside the window.
+        date_from, date_to: 'YYYY-MM-DD' strings or dates, inclusive.
+            review_date is free text in the db, so these are applied to
+            the decoded date column in Parse.parse_lines instead.
+    List values go into temp tables rather than bound parameters, since
+    attraction lists can exceed SQLite's parameter limit.  Any other
+    key raises ValueError, since a misspelt one would otherwise quietly
+    replace DEFAULT_FILTERS with no filtering at all.
+    Returns (predicates, params, temp_tables).
+    """
+    unknown = set(filters) - set(LIST_FILTERS) - OTHER_FILTERS
+    if unknown:
+        raise ValueError("unknown filters: {}".format(", ".join(sorted(unknown))))
+    preds = ["reviews.uid != ''"]
+    params = []
+    tables = {}
+    for name in sorted(filters):
+        if name not in LIST_FILTERS:
+            continue
+        col, negate = LIST_FILTERS[name]
+        values = list(filters[name])
+        table = 'filter_' + name
+        tables[table] = [x for x in values if x is not None]
+        subqry = "(SELECT value FROM temp.{})".format(table)
+        if negate:
+            test = "{} NOT IN {}".format(col, subqry)
+        elif None in values:
+            test = "({} IN {} OR {} IS NULL)".format(col, subqry, col)
+        else:
+            test = "{} IN {}".format(col, subqry)
+        preds.append(test)
+
+    min_reviews = filters.get('min_item_reviews')
+    if min_reviews:
+        # count only the reviews parse_lines keeps (non-empty, non-zero rating)
+        rated = "reviews.rating IS NOT NULL AND reviews.rating != '' AND reviews.rating != 0"
+        preds.append("""reviews.aid IN (SELECT aid FROM reviews WHERE {}
+                    GROUP BY aid HAVING COUNT(*) >= ?)""".format(" AND ".join(preds + [rated])))
+        params.append(min_reviews)
+    return preds, params, tables
+
+
+def to_epoch_days(value):
+    if value is None:
+        return None
+    if not isinstance(value, date):
+        value = decode_date(value) or parse(value).date()
+    return value.toordinal() - EPOCH
+
+
+def create_indexes(dbname):
+    """
+    Creates the indexes used by the filters in compile_filters
+    """
+    indexes = [('idx_reviews_country', 'reviews(country)'),
+               ('idx_reviews_lang', 'reviews(lang)'),
+               ('idx_reviews_aid', 'reviews(aid)'),
+               ('idx_activities_aid', 'activities(aid)')]
+    conn = sqlite3.connect(dbname)
+    try:
+        for name, target in indexes:
+            conn.execute("CREATE INDEX IF NOT EXISTS {} ON {}".format(name, target))
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
 class Parse(object):
     """
-    A class to parse the database file.  Returns a list of Review objects.
-    Calls get_sql_data() then parse_lines(lines)
+    A class to parse the database file into a columnar ReviewData.
+    Streams rows from get_sql_data() in chunks of chunksize and converts
+    each chunk with parse_lines(lines), so only one chunk of raw tuples
+    is alive at a time.
+
+    filters selects the reviews inside SQLite, see compile_filters.
+    It replaces the default, which drops USA reviews as before.
+
+    If cache_dir is given the parsed columns are stored there (see
+    ReviewData.save) in cache_dir/<query key>/<version key>, keyed by
+    the db path and query and then by the db file's size/mtime, and
+    later runs memory map them instead of re-parsing.  Saving a new
+    version removes the older ones of the same query.
+
+    With incremental=True the cache key leaves out size/mtime and the
+    cache records the highest reviews.rowid read.  Loading it then only
+    parses rows above that mark and appends them (see update), growing
+    the id maps in place so existing indices stay valid.
     """
-    def __init__(self, dbname):
-        self.review_list = []
+    def __init__(self, dbname, chunksize=50000, cache_dir=None, filters=None,
+                 incremental=False):
+        self.data = None
+        self.incremental = incremental
+        self.hwm = 0
+        if filters is None:
+            filters = DEFAULT_FILTERS
+        self.filters = filters
+        self.date_from = to_epoch_days(filters.get('date_from'))
+        self.date_to = to_epoch_days(filters.get('date_to'))
+        self.chunksize = chunksize
+        self.cache_dir = cache_dir
         self.nusers = None
         self.nitems = None
         self.dbname = dbname
+        self.ngroups = None
+        self.decode_dates = DateDecoder()
 
         qrycols = ['key','country','uid','aid','name','rating','location','review_date','lang','user_home']
         qrycols = [ 'reviews.'+x for x in qrycols]
+        qrycols.append('reviews.rowid')
         qrycols.append('activities.tags')
         qrycols.append('activities.kgroup')
         self.qrycols = qrycols
         self.cols = [x.split('.')[1] for x in self.qrycols]
+        self.maps = dict((name, IdMap()) for name in ReviewData.map_names)
+
+        cache = self.cache_path()
+        if cache and os.path.exists(cache):
+            self.data = ReviewData.load(cache)
+            self.maps = self.data.maps
+            self.hwm = self.data.meta.get('hwm', 0)
+            self.ngroups = self.data.kgroup.shape[1]
+            if incremental:
+                self.update()
+        else:
+            self.data = self.read()
+            self.save()
+        self.set_sizes()
+
+    def set_sizes(self):
+        self.nusers = self.data.nusers
+        self.nitems = self.data.nitems
+        self.date_fallbacks = self.decode_dates.fallbacks
+
+    def max_rowid(self):
+        with sqlite3.connect(self.dbname) as conn:
+            return conn.execute("SELECT MAX(rowid) FROM reviews").fetchone()[0] or 0
+
+    def read(self, since=None):
+        # rows up to the current end of the table are accounted for even
+        # when the filters drop the last ones, so update can tell nothing
+        # changed
+        maxrow = self.max_rowid()
+        parts = [self.parse_lines(lines) for lines in self.get_sql_data(since)]
+        if not parts:
+            parts = [self.parse_lines([])]
+        self.hwm = max(self.hwm, maxrow)
+        data = ReviewData.concat(parts, self.maps)
+        data.meta['hwm'] = self.hwm
+        return data
+
+    def save(self):
+        cache = self.cache_path()
+        if cache:
+            self.data.meta['hwm'] = self.hwm
+            self.data.save(cache)
+            self.prune_cache(cache)
+
+    def update(self):
+        """
+        Appends reviews added to the db since the last read and returns
+        how many were added.  New users/items get the next free indices.
+
+        min_item_reviews depends on every review of an item, and a
+        shrunken table means the db was rebuilt, so both cases re-read
+        everything (the first one keeping the id maps) when the table
+        changed.
+        """
+        maxrow = self.max_rowid()
+        nold = len(self.data)
+        if maxrow < self.hwm:
+            self.maps = dict((name, IdMap()) for name in ReviewData.map_names)
+            self.hwm = 0
+            self.data = self.read()
+            nold = 0
+        elif maxrow == self.hwm:
+            return 0
+        elif self.filters.get('min_item_reviews'):
+            self.data = self.read()
+        else:
+            parts = [self.parse_lines(lines) for lines in self.get_sql_data(self.hwm)]
+            self.hwm = max(self.hwm, maxrow)
+            self.data = self.data.extend(parts)
+        self.save()
+        self.set_sizes()
+        return len(self.data) - nold
+
+    def cache_key(self):
+        """
+        (query key, version key).  The first changes with the db path and
+        the query, the second whenever the db file does (constant for
+        incremental caches, which are updated in place).
+        """
+        qry, params, tables = self.get_query()
+        key = [os.path.abspath(self.dbname), self.incremental, qry, params, sorted(tables.items()),
+               self.date_from, self.date_to, ReviewData.columns]
+        version = ['incremental']
+        if not self.incremental:
+            stat = os.stat(self.dbname)
+            version = [stat.st_size, stat.st_mtime]
+        return (hashlib.sha1(json.dumps(key, default=str)).hexdigest()[:16],
+                hashlib.sha1(json.dumps(version)).hexdigest()[:16])
+
+    def cache_path(self):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, *self.cache_key())
+
+    def prune_cache(self, cache):
+        """
+        Removes the other versions next to cache: the same db and query
+        parsed from an older state of the db file.  Processes still
+        mapping them keep their pages until they exit.
+        """
+        parent, current = os.path.split(cache)
+        for name in os.listdir(parent):
+            # skip the current version and saves still in progress
+            if name == current or '.tmp' in name:
+                continue
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
 
-        lines = self.get_sql_data()
-        self.review_list = self.parse_lines(lines)
-        
-        
-    def get_sql_data(self):
-        dbname = self.dbname
+    @property
+    def review_list(self):
+        # kept for older scripts; iterates as Review objects
+        return self.data
+
+    def get_query(self, since=None):
+        """
+        Returns (query, params, temp_tables) for the current filters,
+        restricted to rowid > since if given
+        """
+        preds, params, tables = compile_filters(self.filters)
+        if since is not None:
+            preds.append("reviews.rowid > ?")
+            params.append(since)
         qry = """SELECT {}
-                FROM reviews 
+                FROM reviews
                 LEFT JOIN activities
                 USING (aid)
-                WHERE uid != '' 
-                AND reviews.country != 'USA' 
-                """.format(",".join(self.qrycols))
+                WHERE {}
+                """.format(",".join(self.qrycols), "\n                AND ".join(preds))
+        return qry, params, tables
 
-        with sqlite3.connect(dbname) as conn:
+    def get_sql_data(self, since=None):
+        """
+        Generator yielding lists of at most self.chunksize rows
+        """
+        qry, params, tables = self.get_query(since)
+        conn = sqlite3.connect(self.dbname)
+        try:
             cur = conn.cursor()
-            cur.execute(qry)
-            data = cur.fetchall()
-        return data
+            for table, values in tables.iteritems():
+                cur.execute("CREATE TEMP TABLE {} (value PRIMARY KEY)".format(table))
+                cur.executemany("INSERT OR IGNORE INTO temp.{} VALUES (?)".format(table),
+                                [(x,) for x in values])
+            cur.execute(qry, params)
+            while True:
+                lines = cur.fetchmany(self.chunksize)
+                if not lines:
+                    break
+                yield lines
+        finally:
+            conn.close()
 
     def parse_lines(self, lines):
         """
-        Create review_list filled with Review objects
+        Convert raw rows into a dict of column arrays
         """
         uid_idx = self.cols.index('uid')
         aid_idx = self.cols.index('aid')
@@ -57,25 +733,45 @@ class Parse(object):
         date_idx = self.cols.index('review_date')
         tag_idx = self.cols.index('tags')
         grp_idx = self.cols.index('kgroup')
+        lang_idx = self.cols.index('lang')
+        country_idx = self.cols.index('country')
+        loc_idx = self.cols.index('location')
+        row_idx = self.cols.index('rowid')
 
-        uids = set( [x[uid_idx] for x in lines] )
-        self.nusers = len(uids)
-        aids = set( [x[aid_idx] for x in lines] )
-        self.nitems = len(aids)
+        if lines:
+            self.hwm = max(self.hwm, max(x[row_idx] for x in lines))
+        lines = [x for x in lines if x[rate_idx]]
+        days, years, months = self.decode_dates([x[date_idx] for x in lines])
+        if self.date_from is not None or self.date_to is not None:
+            keep = np.ones(len(lines), dtype=bool)
+            if self.date_from is not None:
+                keep &= days >= self.date_from
+            if self.date_to is not None:
+                keep &= days <= self.date_to
+            lines = [x for x, k in zip(lines, keep) if k]
+            days, years, months = days[keep], years[keep], months[keep]
+        maps = self.maps
+        n = len(lines)
 
-        review_list = []
-
-        for item in lines:
-            item = list(item)
-            
-            if not item[rate_idx]:
-                continue
+        cols = {}
+        cols['date'], cols['year'], cols['month'] = days, years, months
+        cols['rating'] = np.array([x[rate_idx] for x in lines], dtype=np.float32)
+        cols['uid'] = np.array([maps['uid'].add(x[uid_idx]) for x in lines], dtype=np.int32)
+        cols['aid'] = np.array([maps['aid'].add(x[aid_idx]) for x in lines], dtype=np.int32)
+        cols['lang'] = np.array([maps['lang'].add(x[lang_idx]) for x in lines], dtype=np.int16)
+        cols['country'] = np.array([maps['country'].add(x[country_idx]) for x in lines], dtype=np.int16)
+        cols['location'] = np.array([maps['location'].add(x[loc_idx]) for x in lines], dtype=np.int32)
 
-            if item[grp_idx]:
-                item[grp_idx] = [int(x) for x in item[grp_idx].split(',')]
-            item[tag_idx] = [x.strip() for x in item[tag_idx].split(',')]
-            item[date_idx] = parse(item[date_idx])
+        groups = [x[grp_idx] and [int(g) for g in x[grp_idx].split(',')] for x in lines]
+        self.ngroups = max([len(g) for g in groups if g] + [self.ngroups or 0])
+        kgroup = np.zeros([n, self.ngroups], dtype=np.int8)
+        for i, grp in enumerate(groups):
+            if grp:
+                kgroup[i, :len(grp)] = grp
+        cols['kgroup'] = kgroup
 
-            d = dict(zip(self.cols, item))
-            review_list.append(Review(d))
-        return review_list
+        tags = [[maps['tags'].add(t.strip()) for t in x[tag_idx].split(',')] if x[tag_idx] else []
+                for x in lines]
+        cols['ntags'] = np.array([len(t) for t in tags], dtype=np.int64)
+        cols['tag_ids'] = np.array([t for row in tags for t in row], dtype=np.int32)
+        return cols
@@ -0,0 +1,94 @@
+"""
+Array kernels for the SGD inner loops in models.py.
+
+The functions are plain python over numpy arrays.  If numba is installed
+compiled copies are exposed in COMPILED, otherwise only the python
+versions are available.
+"""
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def feature_epoch(order, uids, aids, ratings, cache, U, V, ubias, abias,
+                  k, after, avg, lrate, reg, bias):
+    """
+    One SGD pass over feature k in the given order (the SVD.iterate loop).
+    cache holds the dot product of the features before k per review and
+    after the contribution of the untrained ones.  bias adds and trains
+    ubias/abias/avg as in BiasSVD.  Returns the summed squared error.
+    """
+    sqerr = 0.
+    for n in range(len(order)):
+        i = order[n]
+        u = uids[i]
+        a = aids[i]
+        utmp = U[u, k]
+        vtmp = V[a, k]
+        pred = after + utmp * vtmp + cache[i]
+        if bias:
+            pred += ubias[u] + abias[a] + avg
+        pred = min(5., max(1., pred))
+        err = ratings[i] - pred
+        sqerr += err * err
+
+        U[u, k] += lrate * (err*vtmp - reg*utmp)
+        V[a, k] += lrate * (err*utmp - reg*vtmp)
+        if bias:
+            ubias[u] += lrate * (err - reg*ubias[u])
+            abias[a] += lrate * (err - reg*abias[a])
+    return sqerr
+
+
+def joint_epoch(order, uids, aids, ratings, U, V, ubias, abias,
+                avg, lrate, reg, bias):
+    """
+    One SGD pass updating all features of a review at once.
+    Returns the summed squared error.
+    """
+    nfeats = U.shape[1]
+    sqerr = 0.
+    for n in range(len(order)):
+        i = order[n]
+        u = uids[i]
+        a = aids[i]
+        pred = 0.
+        for f in range(nfeats):
+            pred += U[u, f] * V[a, f]
+        if bias:
+            pred += ubias[u] + abias[a] + avg
+        pred = min(5., max(1., pred))
+        err = ratings[i] - pred
+        sqerr += err * err
+
+        for f in range(nfeats):
+            utmp = U[u, f]
+            vtmp = V[a, f]
+            U[u, f] += lrate * (err*vtmp - reg*utmp)
+            V[a, f] += lrate * (err*utmp - reg*vtmp)
+        if bias:
+            ubias[u] += lrate * (err - reg*ubias[u])
+            abias[a] += lrate * (err - reg*abias[a])
+    return sqerr
+
+
+PYTHON = {'feature_epoch': feature_epoch, 'joint_epoch': joint_epoch}
+
+COMPILED = None
+if njit is not None:
+    COMPILED = dict((name, njit(nogil=True)(func)) for name, func in PYTHON.items())
+
+
+def get_kernels(backend='auto'):
+    """
+    backend is 'numba', 'python' or 'auto' (numba when installed)
+    """
+    if backend == 'auto':
+        backend = 'numba' if COMPILED else 'python'
+    if backend == 'numba':
+        if COMPILED is None:
+            raise ImportError("numba is not installed")
+        return COMPILED
+    return PYTHON
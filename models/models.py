@@ -1,7 +1,23 @@
+import os
+import json
 import numpy as np
+import scipy.sparse as sp
 import sys
+import copy
+import inspect
 import random
 from time import time, sleep
+import kernels
+import parallel
+import retrieval
+import neighbors
+from helper import IdMap, write_dir
+
+
+def get_ratings(review_list):
+    if hasattr(review_list, 'maps'):
+        return review_list.rating.astype(np.float64)
+    return np.array([review.rating for review in review_list], dtype=np.float64)
 
 
 class ErrorTracker(object):
@@ -17,10 +33,124 @@ class ErrorTracker(object):
         self.count = 0
         self.err = 0
 
+    def update_many(self, sq_errs):
+        self.count += len(sq_errs)
+        self.err += sq_errs.sum()
+
     def get_err(self):
         return (self.err/self.count) ** 0.5
 
+
+class BiasFamily(object):
+    """
+    One group of bias terms of a model, for the array based solvers.
+    attr is the dict holding the biases on the model, keys its raw keys
+    and width the length of each value (1 for scalars, e.g. 12 for the
+    month arrays of ambias).  idx holds, for every training review, the
+    position of its term in the flat values array or -1 if none applies.
+    """
+    def __init__(self, attr, idx, keys, width=1):
+        self.attr = attr
+        self.idx = idx
+        self.keys = keys
+        self.width = width
+        self.values = None
+        self.counts = None
+
+
+def review_objects(review_list):
+    """
+    review_list as a list of Review objects; a ReviewData builds one per
+    row, so per-review loops should call this once, not per epoch
+    """
+    if hasattr(review_list, 'maps'):
+        return review_list.reviews()
+    return review_list
+
+
+def key_positions(idmap, keys):
+    """
+    Array mapping every dense index of idmap to the position of its raw
+    key in keys, -1 for ids not in keys
+    """
+    pos = np.empty(len(idmap), dtype=np.int64)
+    pos.fill(-1)
+    for i, key in enumerate(keys):
+        idx = idmap.get(key)
+        if idx >= 0:
+            pos[idx] = i
+    return pos
+
+# attributes that are neither hyperparameters nor fitted parameters
+NOT_PARAMS = set(['review_list', 'size', 'verbose', 'print_iter', 'pool', 'maps',
+                  'seen', 'index', 'reviews', 'err_track', 'kernels', 'uids', 'aids',
+                  'ratings', 'cache', 'order', 'by_user', 'by_item', 'rated', 'families',
+                  'seen_ptr', 'seen_idx', 'item_places'])
+
+
+def get_params(model):
+    """
+    The json serializable settings of a model (lrate, nfeats, items,
+    uidset, ...), leaving out the fitted parameters
+    """
+    params = {}
+    for name, value in model.__dict__.iteritems():
+        if name in NOT_PARAMS or name in model.param_attrs:
+            continue
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, (set, frozenset)):
+            value = {'__set__': list(value)}
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        params[name] = value
+    return params
+
+
+def load_model(path, mmap=True):
+    """
+    Loads a model written by Model.save.  With mmap the arrays are memory
+    mapped copy-on-write, so processes serving the same model share pages.
+    Dict parameters are rebuilt as dicts.  The model is built by its
+    class's __init__ first, so runtime attributes (pool, seen, ...) get
+    their defaults and it can be trained further.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    cls = globals()[meta['class']]
+    params = {}
+    for name, value in meta['params'].iteritems():
+        if isinstance(value, dict) and '__set__' in value:
+            value = set(value['__set__'])
+        params[str(name)] = value
+    # constructor arguments (nusers, nitems for the SVDs) are saved settings
+    args = inspect.getargspec(cls.__init__).args[1:]
+    model = cls(*[params[arg] for arg in args])
+    for name, value in params.iteritems():
+        setattr(model, name, value)
+
+    mode = 'c' if mmap else None
+    for attr in meta['arrays']:
+        setattr(model, attr, np.load(os.path.join(path, attr + '.npy'), mmap_mode=mode))
+    for attr, keys in meta['dicts'].iteritems():
+        values = np.load(os.path.join(path, attr + '.npy'), mmap_mode=mode)
+        if values.ndim == 1:
+            values = values.tolist()
+        setattr(model, attr, dict(zip(keys, values)))
+    if meta['maps'] is not None:
+        model.maps = dict((name, IdMap(keys)) for name, keys in meta['maps'].iteritems())
+    return model
+
+
 class Model(object):
+    # attributes holding the fitted parameters (arrays or dicts)
+    param_attrs = ()
+    # True if the parameters are indexed by the dense uid/aid of the
+    # training maps rather than keyed by raw id
+    dense_ids = False
+
     def __init__(self):
         self.review_list = None
         self.verbose = False
@@ -29,31 +159,76 @@ class Model(object):
         self.err_track = ErrorTracker()
 
     def test(self, review_list):                         
-        err = [ (self.predict(review) - review.rating)**2 for review in review_list]
-        return (sum(err)/len(err))**0.5
+        err = self.predict_many(review_list) - get_ratings(review_list)
+        return np.sqrt(np.mean(err**2))
 
     def get_rmse(self):
-        err = 0.
-        for review in self.review_list:
-            err += (review.rating - self.predict(review))**2
-        return (err/self.size)**0.5
+        return self.test(self.review_list)
+
+    def id_maps(self):
+        if hasattr(self.review_list, 'maps'):
+            return self.review_list.maps
+        return getattr(self, 'maps', None)
+
+    def save(self, path):
+        """
+        Writes the model to directory path: array parameters as .npy,
+        dict parameters as a key list plus a dense .npy of their values,
+        settings and the id maps of the training data as json.  Load with
+        load_model.
+        """
+        meta = {'class': type(self).__name__, 'params': get_params(self),
+                'arrays': [], 'dicts': {}, 'maps': None}
+        arrays = {}
+        for attr in self.param_attrs:
+            value = getattr(self, attr)
+            if isinstance(value, dict):
+                keys = list(value)
+                meta['dicts'][attr] = keys
+                value = np.array([value[key] for key in keys], dtype=np.float64)
+            else:
+                meta['arrays'].append(attr)
+            arrays[attr] = value
+        for attr, value in self.serving_arrays().iteritems():
+            meta['arrays'].append(attr)
+            arrays[attr] = value
+        maps = self.id_maps()
+        if maps is not None:
+            meta['maps'] = dict((name, m.keys) for name, m in maps.iteritems())
+        write_dir(path, arrays, {'meta': meta})
+
+    def serving_arrays(self):
+        """
+        Arrays derived from the training reviews that the model needs
+        after load_model, saved alongside the parameters
+        """
+        return {}
+
+    def predict_many(self, review_list):
+        """
+        Array of clipped predictions.  Models override this with array
+        versions for ReviewData; this fallback calls predict per review.
+        """
+        return np.array([self.predict(review) for review in review_list], dtype=np.float64)
                 
     def avg_rating(self):
+        if hasattr(self.review_list, 'stats'):
+            return self.review_list.stats()['avg']
         total = 0.
         for review in self.review_list:
             total += review.rating
         return total/len(self.review_list)
 
     def proper_rating(self, x):
-        if x > 5: return 5.
-        elif x < 1: return 1.
-        return x
+        return np.clip(x, 1., 5.)
 
 
 class AidAverage(Model):
     """
     Model predicts on average for the attraction
     """
+    param_attrs = ('avgdict',)
+
     def __init__(self):
         super(AidAverage, self).__init__()        
 
@@ -66,6 +241,17 @@ class AidAverage(Model):
         self.review_list = review_list
         self.setup()
 
+        if hasattr(self.review_list, 'maps'):
+            data = self.review_list
+            sums = np.bincount(data.aid, data.rating.astype(np.float64))
+            counts = np.bincount(data.aid)
+            keys = data.maps['aid'].keys
+            for idx in np.nonzero(counts)[0]:
+                self.avgdict[keys[idx]] = sums[idx] / counts[idx]
+            if self.verbose:
+                print "Total Training RMSE {:.3f}".format(self.get_rmse())
+            return
+
         for review in self.review_list:
             aid = review.aid
             if not self.avgdict.get(aid, None):
@@ -83,6 +269,13 @@ class AidAverage(Model):
     def predict(self, review):
         return self.avgdict.get(review.aid, self.avg)
 
+    def predict_many(self, review_list):
+        if not hasattr(review_list, 'maps'):
+            return super(AidAverage, self).predict_many(review_list)
+        keys = review_list.maps['aid'].keys
+        avgs = np.array([self.avgdict.get(key, self.avg) for key in keys])
+        return avgs[review_list.aid]
+
 
 ################### Bias Models ######################
 
@@ -92,30 +285,150 @@ class BaseModel(Model):
     """
     def __init__(self):
         super(BaseModel, self).__init__()
+        self.solver = 'sgd'
+        self.batch_size = 10000
+        self.valid_frac = 0.
+        self.patience = 1
+        self.valid_rmse = None
 
     def train(self, review_list):
-        self.review_list = review_list
+        self.review_list, valid = self.split_valid(review_list)
         self.setup()
+        self.fit(valid)
+
+        if self.verbose:
+            print "Total Training RMSE {:.3f}".format(self.get_rmse())
+
+    def partial_fit(self, review_list):
+        """
+        Trains on review_list (e.g. the daily scrape) starting from the
+        current parameters instead of setup().  Biases of unseen users and
+        items start at 0; avg keeps its trained value.  The 'als' solver
+        uses 'batch' updates here, since solving the biases in closed form
+        from the new reviews alone would forget the old ones.
+        """
+        self.review_list = review_list
+        self.size = len(review_list)
+        solver = self.solver
+        if solver == 'als':
+            self.solver = 'batch'
+        try:
+            self.fit(None)
+        finally:
+            self.solver = solver
+
+    def fit(self, valid):
+        """
+        Epoch loop shared by train and partial_fit.  solver picks how the
+        biases are fitted:
+            'sgd'   - per review stochastic gradient descent (iterate)
+            'batch' - the same updates over index arrays, batch_size
+                      reviews at a time (None for full batch).  Needs a
+                      ReviewData and a bias_families() implementation.
+            'als'   - block coordinate descent, each family solved in
+                      closed form per sweep (als_sweep).  Same
+                      requirements as 'batch'.
+        """
+        if self.solver != 'sgd':
+            self.setup_families()
+        else:
+            # Review objects are built once here, not on every epoch
+            self.reviews = review_objects(self.review_list)
+            if hasattr(valid, 'maps') and self.bias_families(valid) is None:
+                valid = review_objects(valid)
+        try:
+            self.fit_epochs(valid)
+        finally:
+            self.reviews = None
+
+    def fit_epochs(self, valid):
+        """
+        Stops once the epoch's training RMSE, accumulated during the pass
+        itself, stops improving at 3 decimals.  With a validation set
+        (valid_frac > 0) it stops after patience epochs without a better
+        validation RMSE instead and restores the best parameters
+        (valid_rmse holds their score).
+        """
         iter_error = float('inf')
+        best = None
+        bad_epochs = 0
 
         for _ in range(self.max_train_iters):
-            self.stoc_grad_desc()
-            rmse = round(self.get_rmse(), 3)
-            if rmse >= iter_error:
-                break
-            else:
+            rmse = self.epoch()
+            if valid is None:
+                rmse = round(rmse, 3)
+                if rmse >= iter_error:
+                    break
                 iter_error = rmse
+                continue
+
+            if self.solver != 'sgd':
+                self.write_families()
+            valid_err = self.test(valid)
+            if self.verbose:
+                print "train rmse {:.3f} validation rmse {:.3f}".format(rmse, valid_err)
+            if valid_err < iter_error:
+                iter_error = valid_err
+                best = self.get_state()
+                bad_epochs = 0
+            else:
+                bad_epochs += 1
+                if bad_epochs >= self.patience:
+                    break
 
-        if self.verbose:
-            print "Total Training RMSE {:.3f}".format(self.get_rmse())
+        if best is not None:
+            self.set_state(best)
+            self.valid_rmse = iter_error
+        if self.solver != 'sgd':
+            self.write_families()
+
+    def split_valid(self, review_list):
+        """
+        Returns (train, validation) split by valid_frac, validation None
+        if there is none
+        """
+        if not self.valid_frac:
+            return review_list, None
+        perm = np.random.permutation(len(review_list))
+        nvalid = int(len(review_list) * self.valid_frac)
+        if hasattr(review_list, 'take'):
+            return review_list.take(perm[nvalid:]), review_list.take(perm[:nvalid])
+        return [review_list[i] for i in perm[nvalid:]], [review_list[i] for i in perm[:nvalid]]
+
+    def get_state(self):
+        if self.solver != 'sgd':
+            return [fam.values.copy() for fam in self.families]
+        return copy.deepcopy(dict((attr, getattr(self, attr)) for attr in self.param_attrs))
+
+    def set_state(self, state):
+        if self.solver != 'sgd':
+            for fam, values in zip(self.families, state):
+                fam.values = values
+        else:
+            self.__dict__.update(state)
+
+    def epoch(self):
+        """
+        One pass of the chosen solver, returns the training RMSE seen
+        during the pass
+        """
+        if self.solver == 'batch':
+            return self.batch_grad_desc()
+        elif self.solver == 'als':
+            return self.als_sweep()
+        self.stoc_grad_desc()
+        return self.epoch_err.get_err()
 
     def stoc_grad_desc(self):
         self.err_track = ErrorTracker()
-        for idx, review in enumerate(self.review_list):
+        self.epoch_err = ErrorTracker()
+        for idx, review in enumerate(self.reviews):
             if self.verbose and idx > 0 and not idx % self.print_iter:
                 print "iteration #:{} smoothed error: {:.3f}".format(idx, self.err_track.get_err())
                 self.err_track.reset()
-            self.err_track.update( self.iterate(review) )
+            sq_err = self.iterate(review)
+            self.err_track.update(sq_err)
+            self.epoch_err.update(sq_err)
 
     def iterate(self, review):
         pred = self.avg 
@@ -129,10 +442,169 @@ class BaseModel(Model):
         self.avg = self.avg_rating()
         self.size = len(self.review_list)
 
+    ########## array based solvers ##########
+
+    def bias_families(self, data):
+        """
+        List of BiasFamily for the reviews in data; r = avg + sum of terms.
+        None means the model only supports per review training/prediction.
+        """
+        return []
+
+    def family_values(self, fam):
+        """
+        Flat array of the current dict values for fam, 0 for missing keys
+        """
+        current = getattr(self, fam.attr)
+        values = np.zeros(len(fam.keys) * fam.width)
+        for i, key in enumerate(fam.keys):
+            if key in current:
+                values[i*fam.width:(i+1)*fam.width] = current[key]
+        return values
+
+    def predict_many(self, review_list):
+        families = None
+        if hasattr(review_list, 'maps'):
+            families = self.bias_families(review_list)
+        if families is None:
+            return super(BaseModel, self).predict_many(review_list)
+
+        pred = np.empty(len(review_list))
+        pred.fill(self.avg)
+        for fam in families:
+            mask = fam.idx >= 0
+            pred[mask] += self.family_values(fam)[fam.idx[mask]]
+        return self.proper_rating(pred)
+
+    def family(self, data, attr, col, keys=None, width=1, sub=None, mask=None):
+        """
+        Builds the BiasFamily for dict attr keyed by the raw ids of column
+        col, restricted to keys if given.  For width > 1 sub is the
+        per-review slot inside the value array.  Reviews where mask is
+        False get no term.
+        """
+        ids = getattr(data, col)
+        if keys is None:
+            keys = list(data.maps[col].keys)
+            idx = ids.astype(np.int64)
+        else:
+            keys = list(keys)
+            idx = key_positions(data.maps[col], keys)[ids]
+        if width > 1:
+            sub = np.asarray(sub, dtype=np.int64)
+            idx = np.where((idx >= 0) & (sub >= 0) & (sub < width), idx*width + sub, -1)
+        if mask is not None:
+            idx[~mask] = -1
+        return BiasFamily(attr, idx, keys, width)
+
+    def setup_families(self):
+        if not hasattr(self.review_list, 'maps'):
+            raise ValueError("solver '{}' needs a ReviewData".format(self.solver))
+        self.families = self.bias_families(self.review_list)
+        if self.families is None:
+            raise ValueError("{} has no solver '{}'".format(type(self).__name__, self.solver))
+        for fam in self.families:
+            fam.values = self.family_values(fam)
+            fam.counts = np.bincount(fam.idx[fam.idx >= 0], minlength=len(fam.values))
+
+    def write_families(self):
+        """
+        Copies the fitted arrays back into the bias dicts used by predict
+        """
+        for fam in self.families:
+            current = getattr(self, fam.attr)
+            hit = fam.counts.reshape(-1, fam.width).sum(1) > 0
+            if fam.width == 1:
+                values = fam.values.tolist()
+            else:
+                values = fam.values.reshape(-1, fam.width)
+            for i, key in enumerate(fam.keys):
+                if hit[i] or key in current:
+                    current[key] = values[i]
+
+    def batch_predict(self, rows=None):
+        """
+        Unclipped predictions for the training reviews in rows (all if None)
+        """
+        n = self.size if rows is None else len(rows)
+        pred = np.empty(n)
+        pred.fill(self.avg)
+        for fam in self.families:
+            idx = fam.idx if rows is None else fam.idx[rows]
+            mask = idx >= 0
+            pred[mask] += fam.values[idx[mask]]
+        return pred
+
+    def batch_grad_desc(self):
+        """
+        One epoch of the 'batch' solver, returns the training RMSE seen
+        over the epoch.
+        Each family is updated in turn from the residual left by the
+        others.  A bias hit by n reviews of a batch moves 1-(1-lrate)**n
+        of the way along its mean gradient, which is what n consecutive
+        SGD steps would do, and exactly one SGD step when n == 1.
+        """
+        ratings = self.review_list.rating
+        order = np.random.permutation(self.size)
+        bsize = self.batch_size or self.size
+        self.err_track = ErrorTracker()
+
+        for start in xrange(0, self.size, bsize):
+            rows = order[start:start+bsize]
+            err = ratings[rows] - self.batch_predict(rows)
+            self.err_track.update_many(err**2)
+
+            for fam in self.families:
+                idx = fam.idx[rows]
+                mask = idx >= 0
+                idx = idx[mask]
+                if not len(idx):
+                    continue
+                size = len(fam.values)
+                count = np.bincount(idx, minlength=size)
+                total = np.bincount(idx, weights=err[mask], minlength=size)
+                hit = count > 0
+                step = 1 - (1 - self.lrate) ** count[hit]
+                change = np.zeros(size)
+                change[hit] = step * (total[hit]/count[hit] - self.reg_term * fam.values[hit])
+                fam.values += change
+                err[mask] -= change[idx]
+
+        if self.verbose:
+            print "epoch error: {:.3f}".format(self.err_track.get_err())
+        return self.err_track.get_err()
+
+    def als_sweep(self):
+        """
+        One sweep of the 'als' solver, returns the training RMSE after it
+        (unclipped, from the residual kept up to date here).  Each
+        family in turn is set to the regularized group means of the
+        residual left by the others, b = sum(resid) / (n * (1 + reg_term)),
+        which is the fixed point of the SGD update.
+        """
+        err = self.review_list.rating - self.batch_predict()
+        for fam in self.families:
+            mask = fam.idx >= 0
+            idx = fam.idx[mask]
+            size = len(fam.values)
+            total = np.bincount(idx, weights=err[mask] + fam.values[idx], minlength=size)
+            hit = fam.counts > 0
+            new = fam.values.copy()
+            new[hit] = total[hit] / (fam.counts[hit] * (1 + self.reg_term))
+            err[mask] -= (new - fam.values)[idx]
+            fam.values = new
+
+        rmse = np.sqrt(np.mean(err**2))
+        if self.verbose:
+            print "sweep error: {:.3f}".format(rmse)
+        return rmse
+
 class ItemModel(BaseModel):
     """
     r = global_avg + item_bias(item)
     """
+    param_attrs = ('abias',)
+
     def __init__(self):
         super(ItemModel, self).__init__()
         self.lrate = 0.01
@@ -156,11 +628,16 @@ class ItemModel(BaseModel):
         bi = self.abias.get(review.aid,0)
         return self.proper_rating(self.avg + bi)
 
+    def bias_families(self, data):
+        return [self.family(data, 'abias', 'aid')]
+
 
 class LangItemModel(BaseModel):
     """
     r = global_avg + item_bias(item) + lang_bias(lang)
     """
+    param_attrs = ('lbias', 'abias')
+
     def __init__(self):
         super(LangItemModel, self).__init__()
         self.lrate = 0.01
@@ -194,11 +671,17 @@ class LangItemModel(BaseModel):
         bi = self.abias.get(review.aid,0)
         return self.proper_rating(self.avg + bi + bl)
 
+    def bias_families(self, data):
+        return [self.family(data, 'lbias', 'lang', keys=self.lbias),
+                self.family(data, 'abias', 'aid')]
+
 
 class LangModel(BaseModel):
     """
     r = global_avg + lang_bias(lang)
     """
+    param_attrs = ('lbias',)
+
     def __init__(self):
         super(LangModel, self).__init__()
         self.lrate = 0.01
@@ -221,10 +704,15 @@ class LangModel(BaseModel):
     def predict(self, review):
         return self.proper_rating(self.avg + self.lbias.get(review.lang,0))        
 
+    def bias_families(self, data):
+        return [self.family(data, 'lbias', 'lang', keys=self.lbias)]
+
 class UserModel(BaseModel):
     """
     r = global_avg + user_bias(user)
     """
+    param_attrs = ('ubias',)
+
     def __init__(self):
         super(UserModel, self).__init__()
         #self.nusers = nusers
@@ -251,11 +739,16 @@ class UserModel(BaseModel):
             bu = self.ubias[review.uid]
         return self.proper_rating(self.avg + bu)
 
+    def bias_families(self, data):
+        return [self.family(data, 'ubias', 'uid')]
+
 
 class SelectUserModel(BaseModel):
     """
     r = global_avg + user_bias(user_from_uidset)
     """
+    param_attrs = ('ubias',)
+
     def __init__(self):
         super(SelectUserModel, self).__init__()
         self.uidset = None
@@ -287,11 +780,16 @@ class SelectUserModel(BaseModel):
             bu = self.ubias[review.uid]
         return self.proper_rating(self.avg + bu)
 
+    def bias_families(self, data):
+        return [self.family(data, 'ubias', 'uid', keys=self.uidset)]
+
 
 class SelectItemModel(BaseModel):
     """
     r = global_avg + item_bias(item)
     """
+    param_attrs = ('abias',)
+
     def __init__(self):
         super(SelectItemModel, self).__init__()
         self.lrate = 0.01
@@ -316,10 +814,15 @@ class SelectItemModel(BaseModel):
         abias = self.abias.get(review.aid, 0)
         return self.proper_rating(self.avg + abias)
 
+    def bias_families(self, data):
+        return [self.family(data, 'abias', 'aid', keys=self.items)]
+
 class ItemMonthModel(BaseModel):
     """
     r = global_avg + month_loc_bias(location, month)
     """
+    param_attrs = ('ambias',)
+
     def __init__(self):
         super(ItemMonthModel, self).__init__()
         self.lrate = 0.01
@@ -348,10 +851,16 @@ class ItemMonthModel(BaseModel):
 
         return self.proper_rating(self.avg + bias)
 
+    def bias_families(self, data):
+        month = data.month - 1
+        return [self.family(data, 'ambias', 'aid', keys=self.items, width=12, sub=month)]
+
 class UserTagModel(BaseModel):
     """
     r = global_avg + user_group_bias(user, tags)
     """
+    param_attrs = ('ubias',)
+
     def __init__(self):
         super(UserGroupModel, self).__init__()
         self.lrate = 0.01
@@ -395,10 +904,15 @@ class UserTagModel(BaseModel):
                 bias += self.ubias[review.uid].get(tag, 0)
         return self.proper_rating(self.avg + bias)
 
+    def bias_families(self, data):
+        return None
+
 class UserGroupModel(BaseModel):
     """
     r = global_avg + user_group_bias(user, group) + user_bias(user)
     """
+    param_attrs = ('gbias', 'ubias')
+
     def __init__(self):
         super(UserGroupModel, self).__init__()
         self.lrate = 0.01
@@ -444,10 +958,18 @@ class UserGroupModel(BaseModel):
         bu = self.ubias[review.uid]
         return self.proper_rating(self.avg + bg + bu)
 
+    def bias_families(self, data):
+        kgrp = data.kgroup[:, self.group].astype(np.int64) - 1
+        mask = kgrp >= 0
+        return [self.family(data, 'gbias', 'uid', keys=self.uidset, width=self.groupsize, sub=kgrp, mask=mask),
+                self.family(data, 'ubias', 'uid', keys=self.uidset, mask=mask)]
+
 class GroupModel(BaseModel):
     """
     r = global_avg + user_group_bias(user, group)
     """
+    param_attrs = ('ubias',)
+
     def __init__(self):
         super(GroupModel, self).__init__()
         self.lrate = 0.01
@@ -486,7 +1008,13 @@ class GroupModel(BaseModel):
         kgrp = review.kgroup[self.group] - 1
         return self.proper_rating(self.avg + self.ubias[review.uid][kgrp])
 
+    def bias_families(self, data):
+        kgrp = data.kgroup[:, self.group].astype(np.int64) - 1
+        return [self.family(data, 'ubias', 'uid', keys=self.uidset, width=self.groupsize, sub=kgrp)]
+
 class CombinedModelAll(BaseModel):
+    param_attrs = ('ubias', 'gbias', 'abias', 'ambias')
+
     def __init__(self):
         super(CombinedModel, self).__init__()
         self.lrate = 0.01
@@ -564,8 +1092,13 @@ class CombinedModelAll(BaseModel):
 
         return self.proper_rating(self.avg + bu + ba + bam)
 
+    def bias_families(self, data):
+        return None
+
 
 class CombinedModel(BaseModel):
+    param_attrs = ('ubias', 'abias', 'ambias', 'lbias')
+
     def __init__(self):
         super(CombinedModel, self).__init__()
         self.lrate = 0.01
@@ -626,10 +1159,51 @@ class CombinedModel(BaseModel):
 
         return self.proper_rating(self.avg + bu + ba + bam + bl)    
 
+    def bias_families(self, data):
+        # abias only covers the attractions without month biases
+        plain = key_positions(data.maps['aid'], self.aid_list)[data.aid] < 0
+        return [self.family(data, 'ubias', 'uid'),
+                self.family(data, 'lbias', 'lang', keys=self.lbias),
+                self.family(data, 'ambias', 'aid', keys=self.aid_list, width=12, sub=data.month - 1),
+                self.family(data, 'abias', 'aid', mask=plain)]
+
 
 ################# The SVD class of models #####################
 
+def gather(arr, idx):
+    """
+    arr[idx] with zero rows for indices past the end of arr, i.e. users
+    or items added to the maps after the model was trained
+    """
+    ok = idx < len(arr)
+    if ok.all():
+        return arr[idx]
+    out = np.zeros((len(idx),) + arr.shape[1:])
+    out[ok] = arr[idx[ok]]
+    return out
+
+
+def review_arrays(review_list):
+    """
+    (uid index, aid index, rating) arrays for a ReviewData or a list of
+    Review objects
+    """
+    if hasattr(review_list, 'maps'):
+        return review_list.uid, review_list.aid, review_list.rating.astype(np.float64)
+    uids = np.array([review.uidx for review in review_list], dtype=np.int32)
+    aids = np.array([review.aidx for review in review_list], dtype=np.int32)
+    ratings = np.array([review.rating for review in review_list], dtype=np.float64)
+    return uids, aids, ratings
+
+
 class SVD(Model):
+    """
+    Funk SVD: r = U[user].V[item]
+    """
+    use_bias = False
+    dense_ids = True
+    param_attrs = ('U', 'V', 'ubias', 'abias')
+
     def __init__(self, nusers, nitems): 
         super(SVD, self).__init__()   
         self.nitems = nitems
@@ -639,43 +1213,137 @@ class SVD(Model):
         self.lrate = 0.04
         self.reg_term = 0.01
         self.initbias = 0
+        self.backend = 'auto'
+        self.njobs = 1
+        self.pool = None
+        self.joint = False
+        self.initscale = 0.1
+        self.block_users = 256
+        self.seen = None
+        self.index = None
 
     def setup(self):
         self.size = len(self.review_list)
+        self.uids, self.aids, self.ratings = review_arrays(self.review_list)
         
         self.avg = self.avg_rating()
         self.initval = (self.avg/self.nfeats) ** 0.5        
 
-        self.U = np.empty([self.nusers, self.nfeats])
-        self.U.fill(self.initval)
-        self.V = np.empty([self.nitems, self.nfeats])
-        self.V.fill(self.initval)
+        if self.joint:
+            self.U = np.random.normal(0, self.initscale, [self.nusers, self.nfeats])
+            self.V = np.random.normal(0, self.initscale, [self.nitems, self.nfeats])
+        else:
+            self.U = np.empty([self.nusers, self.nfeats])
+            self.U.fill(self.initval)
+            self.V = np.empty([self.nitems, self.nfeats])
+            self.V.fill(self.initval)
 
-        self.cache = np.empty([self.nusers, self.nitems])
+        self.cache = np.zeros(self.size)
+        self.order = np.arange(self.size)
         self.ubias = np.zeros(self.nusers)
         self.abias = np.zeros(self.nitems)
+        self.seen = None
+        self.index = None
 
     def stoc_grad_desc(self, k):
         self.err_track = ErrorTracker()
-        for idx, review in enumerate(self.review_list):
+        if self.pool is not None:
+            self.hogwild_epoch(k)
+            return
+
+        if self.kernels is not kernels.PYTHON:
+            after = (self.nfeats-k-1) * self.initval**2
+            sqerr = self.kernels['feature_epoch'](
+                self.order, self.uids, self.aids, self.ratings, self.cache,
+                self.U, self.V, self.ubias, self.abias, k, after, self.avg,
+                self.lrate, self.reg_term, self.use_bias)
+            self.err_track.err, self.err_track.count = sqerr, self.size
+            return
+
+        for idx, i in enumerate(self.order):
             if self.verbose and idx > 0 and not idx % self.print_iter:
                 print "iteration #:{} error: {:.3f}".format(idx, self.err_track.get_err())
                 self.err_track.reset()
-            self.iterate(review, k)
+            self.iterate(i, k)
 
+    def joint_grad_desc(self):
+        self.err_track = ErrorTracker()
+        if self.pool is not None:
+            self.hogwild_epoch(None)
+            return
+
+        sqerr = self.kernels['joint_epoch'](
+            self.order, self.uids, self.aids, self.ratings,
+            self.U, self.V, self.ubias, self.abias, self.avg,
+            self.lrate, self.reg_term, self.use_bias)
+        self.err_track.err, self.err_track.count = sqerr, self.size
+
+    def hogwild_start(self):
+        """
+        njobs > 1 trains Hogwild style: U, V, the biases, the cache and
+        the visiting order live in shared memory and each epoch's order is
+        split across njobs forked workers that update them without locks.
+        Results are not bit-reproducible; training RMSE stays within
+        ~0.01 of the serial run.
+        """
+        for name in ['U', 'V', 'ubias', 'abias', 'cache', 'order']:
+            setattr(self, name, parallel.to_shared(getattr(self, name)))
+        self.pool = parallel.fork_pool(self.njobs, model=self)
+
+    def hogwild_stop(self):
+        parallel.close_pool(self.pool)
+        self.pool = None
+
+    def hogwild_epoch(self, k):
+        """
+        One epoch over feature k (all features if k is None) split across
+        the worker pool
+        """
+        parts = [(start, stop, k) for start, stop in parallel.chunks(self.size, self.njobs)]
+        sqerr = sum(self.pool.map(_hogwild_part, parts))
+        self.err_track.err, self.err_track.count = sqerr, self.size
 
     def train(self, review_list):
         """
         Iterate over
             - features
             - stochastic gradient descent
+        backend is 'python' (the iterate loop), 'numba' (compiled kernels
+        from kernels.py) or 'auto'.
         """
         self.review_list = review_list
         self.setup()
+        self.kernels = kernels.get_kernels(self.backend)
+        if self.njobs > 1:
+            self.hogwild_start()
+        try:
+            self.sgd()
+        finally:
+            if self.pool is not None:
+                self.hogwild_stop()
+
+    def sgd(self):
+        """
+        Trains feature by feature.  The dot product of the features
+        already trained is cached per training review (self.cache is
+        aligned with self.uids/self.aids), so memory is O(nreviews +
+        (nusers+nitems)*nfeats).  joint=True trains all features at once
+        per review for max_train_iters epochs instead; the factors then
+        start from N(0, initscale) noise (see setup) so the features can
+        diverge from each other.
+        """
+        if self.joint:
+            for iters in range(self.max_train_iters):
+                np.random.shuffle(self.order)
+                self.joint_grad_desc()
+                if self.verbose:
+                    print "epoch:{} error: {:.3f}".format(iters+1, self.err_track.get_err())
+            return
 
         prev_err = 0        
         for k in range(self.nfeats):
-            random.shuffle(self.review_list)
+            # shuffle the visiting order, not the reviews, so the cache stays aligned
+            np.random.shuffle(self.order)
 
             for iters in range(self.max_train_iters):
                 t0 = time()
@@ -686,46 +1354,293 @@ class SVD(Model):
             self.update_cache(k)
 
     def update_cache(self, k):
-        for review in self.review_list:
-            uid = review.uid
-            aid = review.aid
-            self.cache[uid][aid] += self.U[uid][k] * self.V[aid][k]
+        self.cache += self.U[self.uids, k] * self.V[self.aids, k]
+
+    def grow(self, nusers, nitems):
+        """
+        Adds zero factor/bias rows so that nusers and nitems fit
+        """
+        if nusers > self.nusers or nitems > self.nitems:
+            self.seen = None
+            self.index = None
+        if nusers > self.nusers:
+            self.U = np.vstack([self.U, np.zeros([nusers - self.nusers, self.nfeats])])
+            self.ubias = np.concatenate([self.ubias, np.zeros(nusers - self.nusers)])
+            self.nusers = nusers
+        if nitems > self.nitems:
+            self.V = np.vstack([self.V, np.zeros([nitems - self.nitems, self.nfeats])])
+            self.abias = np.concatenate([self.abias, np.zeros(nitems - self.nitems)])
+            self.nitems = nitems
+
+    def grow_to(self, review_list):
+        uids, aids, ratings = review_arrays(review_list)
+        if len(uids):
+            self.grow(uids.max() + 1, aids.max() + 1)
+        return uids, aids, ratings
+
+    def partial_fit(self, review_list):
+        """
+        Trains on new reviews from the current factors, adding zero rows
+        for unseen users/items and updating all features jointly
+        """
+        self.review_list = review_list
+        self.size = len(review_list)
+        self.uids, self.aids, self.ratings = self.grow_to(review_list)
+        self.order = np.arange(self.size)
+        self.kernels = kernels.get_kernels(self.backend)
+        self.seen = None
+        self.index = None
+        for iters in range(self.max_train_iters):
+            np.random.shuffle(self.order)
+            self.joint_grad_desc()
+
+    ########## top k retrieval ##########
+
+    def seen_items(self, review_list=None):
+        """
+        Boolean CSR user x item matrix of the reviewed pairs in
+        review_list, by default the training reviews (as saved by save
+        for a loaded model).  Cached in self.seen for
+        recommend(exclude_seen=True).
+        """
+        if review_list is None:
+            if not hasattr(self, 'uids') and hasattr(self, 'seen_ptr'):
+                ones = np.ones(len(self.seen_idx), dtype=bool)
+                nusers = len(self.seen_ptr) - 1
+                seen = sp.csr_matrix((ones, self.seen_idx, self.seen_ptr),
+                                     shape=(nusers, self.nitems))
+                self.seen = seen if nusers == self.nusers else self.grow_seen(seen)
+                return self.seen
+            if not hasattr(self, 'uids'):
+                raise ValueError("no training reviews, pass review_list")
+            uids, aids = self.uids, self.aids
+        else:
+            uids, aids, _ = review_arrays(review_list)
+        ones = np.ones(len(uids), dtype=np.int32)
+        mat = sp.coo_matrix((ones, (uids, aids)), shape=(self.nusers, self.nitems)).tocsr()
+        self.seen = mat.astype(bool)
+        return self.seen
+
+    def item_filter(self, country=None, location=None, review_list=None):
+        """
+        Indices of the items reviewed in review_list (by default the
+        training reviews) whose attraction is in country and/or location
+        """
+        data = self.review_list if review_list is None else review_list
+        if not hasattr(data, 'maps'):
+            places = getattr(self, 'item_places', None) if review_list is None else None
+            if places is None:
+                raise ValueError("item_filter needs a ReviewData, pass review_list")
+            # (aid, country, location) triples saved with the model
+            maps = self.id_maps()
+            keep = np.ones(len(places), dtype=bool)
+            if country is not None:
+                keep &= places[:, 1] == maps['country'].get(country)
+            if location is not None:
+                keep &= places[:, 2] == maps['location'].get(location)
+            return np.unique(places[keep, 0])
+        keep = np.ones(len(data), dtype=bool)
+        if country is not None:
+            keep &= data.country == data.maps['country'].get(country)
+        if location is not None:
+            keep &= data.location == data.maps['location'].get(location)
+        return np.unique(data.aid[keep])
+
+    def grow_seen(self, seen):
+        # a partial_fit after loading may have added users
+        extra = sp.csr_matrix((self.nusers - seen.shape[0], seen.shape[1]), dtype=bool)
+        return sp.vstack([seen, extra]).tocsr()
+
+    def serving_arrays(self):
+        """
+        The seen matrix as CSR index arrays and the distinct (item,
+        country, location) index triples of the training reviews, so
+        that recommend and item_filter work on a loaded model
+        """
+        out = {}
+        if self.seen is not None or hasattr(self, 'uids') or hasattr(self, 'seen_ptr'):
+            seen = self.seen if self.seen is not None else self.seen_items()
+            out['seen_ptr'], out['seen_idx'] = seen.indptr, seen.indices
+        data = self.review_list
+        if hasattr(data, 'maps'):
+            places = np.column_stack([data.aid, data.country, data.location]).astype(np.int64)
+            out['item_places'] = np.unique(places, axis=0)
+        elif getattr(self, 'item_places', None) is not None:
+            out['item_places'] = self.item_places
+        return out
+
+    def item_vectors(self):
+        """
+        Item factors with the item bias appended, so that a user vector
+        with a trailing 1 scores U.V + abias
+        """
+        bias = self.abias if self.use_bias else np.zeros(self.nitems)
+        return np.hstack([self.V, bias[:, None]])
+
+    def item_neighbors(self, n=20):
+        """
+        neighbors.NeighborIndex of the top n items by cosine similarity
+        of their factor vectors, keyed by the raw aids
+        """
+        keys = self.id_maps()['aid'].keys[:self.nitems]
+        return neighbors.NeighborIndex(n).fit(self.V[:len(keys)], keys)
+
+    def build_index(self, nlist=None, nprobe=8):
+        """
+        Approximate index (retrieval.FactorIndex) over item_vectors, used
+        by recommend(approx=True)
+        """
+        self.index = retrieval.FactorIndex(self.item_vectors(), nlist, nprobe)
+        return self.index
+
+    def recommend(self, users, k=10, exclude_seen=True, items=None, approx=False):
+        """
+        Top k items for each user index in users (an int or an array).
+        Users and items are dense indices: map raw uids with
+        id_maps()['uid'].get and the returned items back with
+        id_maps()['aid'].keys.  items restricts the candidates (see
+        item_filter).  Returns (items, predicted ratings) arrays of shape
+        (len(users), k), best first; rows are padded with -1 / nan when
+        fewer items qualify.  Users are scored in blocks of block_users
+        against all candidates; approx=True searches the index from
+        build_index instead.
+        """
+        single = np.isscalar(users)
+        users = np.atleast_1d(users).astype(np.int64)
+        if items is None:
+            items = np.arange(self.nitems)
+        items = np.asarray(items, dtype=np.int64)
+        seen = None
+        if exclude_seen:
+            seen = getattr(self, 'seen', None)
+            if seen is None:
+                seen = self.seen_items()
+
+        out_items = np.empty([len(users), k], dtype=np.int64)
+        out_items.fill(-1)
+        out_scores = np.empty([len(users), k])
+        out_scores.fill(np.nan)
+        if approx:
+            self.approx_recommend(users, k, items, seen, out_items, out_scores)
+        else:
+            V = self.V[items]
+            abias = self.abias[items] if self.use_bias else np.zeros(len(items))
+            # column of each item in the candidate list, -1 if not a candidate
+            pos = np.empty(self.nitems, dtype=np.int64)
+            pos.fill(-1)
+            pos[items] = np.arange(len(items))
+            for start in range(0, len(users), self.block_users):
+                block = users[start:start+self.block_users]
+                scores = gather(self.U, block).dot(V.T) + abias
+                if seen is not None:
+                    rows = seen[np.minimum(block, self.nusers - 1)].tocoo()
+                    cols = pos[rows.col]
+                    ok = (cols >= 0) & (block[rows.row] < self.nusers)
+                    scores[rows.row[ok], cols[ok]] = -np.inf
+                idx, best = retrieval.top_k(scores, k)
+                width = idx.shape[1]
+                valid = np.isfinite(best)
+                out_items[start:start+len(block), :width] = np.where(valid, items[idx], -1)
+                out_scores[start:start+len(block), :width] = np.where(valid, best, np.nan)
+        if self.use_bias:
+            out_scores += (gather(self.ubias, users) + self.avg)[:, None]
+        out_scores = self.proper_rating(out_scores)
+        if single:
+            return out_items[0], out_scores[0]
+        return out_items, out_scores
+
+    def approx_recommend(self, users, k, items, seen, out_items, out_scores):
+        if getattr(self, 'index', None) is None:
+            self.build_index()
+        allowed = np.zeros(self.nitems, dtype=bool)
+        allowed[items] = True
+        for row, user in enumerate(users):
+            mask = allowed
+            if seen is not None and user < self.nusers:
+                mask = allowed.copy()
+                mask[seen.indices[seen.indptr[user]:seen.indptr[user+1]]] = False
+            query = np.append(gather(self.U, users[row:row+1])[0], 1.)
+            found, scores = self.index.search(query, k, mask)
+            out_items[row, :len(found)] = found
+            out_scores[row, :len(found)] = scores
+
+
+def _hogwild_part(args):
+    """
+    Worker side of SVD.hogwild_epoch, runs the kernel on one slice of the
+    shared visiting order
+    """
+    start, stop, k = args
+    model = parallel.STATE['model']
+    funcs = model.kernels
+    order = model.order[start:stop]
+    if k is None:
+        return funcs['joint_epoch'](
+            order, model.uids, model.aids, model.ratings,
+            model.U, model.V, model.ubias, model.abias, model.avg,
+            model.lrate, model.reg_term, model.use_bias)
+    after = (model.nfeats-k-1) * model.initval**2
+    return funcs['feature_epoch'](
+        order, model.uids, model.aids, model.ratings, model.cache,
+        model.U, model.V, model.ubias, model.abias, k, after, model.avg,
+        model.lrate, model.reg_term, model.use_bias)
 
 
 class BiasSVD(SVD):
     # to check this.  I need to compare against both linear and SVD.  They're both working
+    use_bias = True
 
     def __init__(self, nusers, nitems):    
         super(BiasSVD, self).__init__(nusers, nitems)
         self.initval = 0
         # ubias, abias are located in SVD.setup()
 
-    def iterate(self, review, k):
-        err = review.rating - self.cached_predict(review, k)
+    def iterate(self, i, k):
+        uid = self.uids[i]
+        aid = self.aids[i]
+        err = self.ratings[i] - self.cached_predict(i, k)
         self.err_track.update(err**2)
 
-        uTemp = self.U[review.uid][k]
-        vTemp = self.V[review.aid][k]
-        ubias = self.ubias[review.uid]
-        abias = self.abias[review.aid]
+        uTemp = self.U[uid][k]
+        vTemp = self.V[aid][k]
+        ubias = self.ubias[uid]
+        abias = self.abias[aid]
 
-        self.U[review.uid][k] += self.lrate * (err*vTemp - self.reg_term*uTemp)
-        self.V[review.aid][k] += self.lrate * (err*uTemp - self.reg_term*vTemp)
-        self.ubias[review.uid] += self.lrate * (err - self.reg_term * ubias)
-        self.abias[review.aid] += self.lrate * (err - self.reg_term * abias)
+        self.U[uid][k] += self.lrate * (err*vTemp - self.reg_term*uTemp)
+        self.V[aid][k] += self.lrate * (err*uTemp - self.reg_term*vTemp)
+        self.ubias[uid] += self.lrate * (err - self.reg_term * ubias)
+        self.abias[aid] += self.lrate * (err - self.reg_term * abias)
         return err**2
 
     def predict(self, review):
-        uid = review.uid
-        aid = review.aid
-        return self.proper_rating( sum(self.U[uid] * self.V[aid]) + self.ubias[uid] + self.abias[aid] + self.avg)
+        uid = review.uidx
+        aid = review.aidx
+        return self.proper_rating( np.dot(self.U[uid], self.V[aid]) + self.ubias[uid] + self.abias[aid] + self.avg)
 
-    def cached_predict(self, review, k):
-        uid = review.uid
-        aid = review.aid
+    def predict_many(self, review_list):
+        uids, aids, _ = review_arrays(review_list)
+        pred = np.einsum('ij,ij->i', gather(self.U, uids), gather(self.V, aids))
+        pred += gather(self.ubias, uids) + gather(self.abias, aids) + self.avg
+        return self.proper_rating(pred)
+
+    def fold_in(self, review_list):
+        """
+        Solves the vector and bias of every user in review_list in closed
+        form from those reviews, with the item factors and biases frozen.
+        Meant for new users: pass all of each user's reviews.
+        """
+        uids, aids, ratings = self.grow_to(review_list)
+        mat = sparse_ratings(uids, aids, ratings, self.nusers, self.nitems)
+        rows, W = solve_rows(mat, 0, self.nusers, self.V, self.abias, self.avg, self.reg_term)
+        self.U[rows] = W[:, :-1]
+        self.ubias[rows] = W[:, -1]
+
+    def cached_predict(self, i, k):
+        uid = self.uids[i]
+        aid = self.aids[i]
         after = (self.nfeats-k-1) * self.initval**2
         current = self.U[uid][k] * self.V[aid][k]
-        before = self.cache[uid][aid]
+        before = self.cache[i]
         return self.proper_rating(after + current + before + self.ubias[uid] + self.abias[aid] + self.avg)
 
 
@@ -738,23 +1653,303 @@ class PlainSVD(SVD):
     max_train_iters
     """
 
-    def iterate(self, review, k):
-        err = review.rating - self.cached_predict(review.uid, review.aid, k)
+    def iterate(self, i, k):
+        uid = self.uids[i]
+        aid = self.aids[i]
+        err = self.ratings[i] - self.cached_predict(i, k)
         self.err_track.update(err**2)
 
-        uTemp = self.U[review.uid][k]
-        vTemp = self.V[review.aid][k]
-        self.U[review.uid][k] += self.lrate * (err*vTemp - self.reg_term*uTemp)
-        self.V[review.aid][k] += self.lrate * (err*uTemp - self.reg_term*vTemp)
+        uTemp = self.U[uid][k]
+        vTemp = self.V[aid][k]
+        self.U[uid][k] += self.lrate * (err*vTemp - self.reg_term*uTemp)
+        self.V[aid][k] += self.lrate * (err*uTemp - self.reg_term*vTemp)
 
 
     def predict(self, review):
-        uid = review.uid
-        aid = review.aid
-        return self.proper_rating( sum(self.U[uid] * self.V[aid]) )
+        uid = review.uidx
+        aid = review.aidx
+        return self.proper_rating( np.dot(self.U[uid], self.V[aid]) )
+
+    def predict_many(self, review_list):
+        uids, aids, _ = review_arrays(review_list)
+        return self.proper_rating(np.einsum('ij,ij->i', gather(self.U, uids), gather(self.V, aids)))
 
-    def cached_predict(self, uid, aid, k):
+    def cached_predict(self, i, k):
         after = (self.nfeats-k-1) * self.initval**2
-        current = self.U[uid][k] * self.V[aid][k]
-        before = self.cache[uid][aid]
+        current = self.U[self.uids[i]][k] * self.V[self.aids[i]][k]
+        before = self.cache[i]
         return self.proper_rating(after + current + before)
+
+
+def sparse_ratings(rows, cols, ratings, nrows, ncols):
+    """
+    CSR matrix with one stored entry per review, sorted by row.  Built
+    from the sorted arrays directly since coo->csr would sum duplicate
+    (row, col) reviews.
+    """
+    order = np.argsort(rows, kind='mergesort')
+    indptr = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=nrows), out=indptr[1:])
+    return sp.csr_matrix((ratings[order], cols[order], indptr), shape=(nrows, ncols))
+
+
+def solve_rows(mat, start, stop, fixed, fixed_bias, avg, reg):
+    """
+    Regularized least squares for rows start:stop of the CSR rating
+    matrix mat, with the factors and biases of the other side frozen.
+    Returns (rows, W) for the rows with ratings; W[:, :-1] are their
+    factor vectors and W[:, -1] their biases.
+    """
+    indptr = mat.indptr[start:stop+1]
+    counts = np.diff(indptr)
+    active = np.nonzero(counts)[0]
+    nfeats = fixed.shape[1]
+    if not len(active):
+        return active, np.zeros([0, nfeats + 1])
+    lo, hi = indptr[0], indptr[-1]
+    other = mat.indices[lo:hi]
+
+    # features of the fixed side plus a constant column for the bias
+    X = np.ones([hi - lo, nfeats + 1])
+    X[:, :-1] = fixed[other]
+    target = mat.data[lo:hi] - avg - fixed_bias[other]
+
+    segs = indptr[active] - lo
+    A = np.add.reduceat(X[:, :, None] * X[:, None, :], segs, axis=0)
+    b = np.add.reduceat(X * target[:, None], segs, axis=0)
+    A += reg * counts[active][:, None, None] * np.eye(nfeats + 1)
+    W = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    return start + active, W
+
+
+class ALSSVD(BiasSVD):
+    """
+    r = global_avg + user_bias + item_bias + U[user].V[item]
+    fitted by alternating least squares.  Each half sweep fixes one side
+    and solves every user (item) vector together with its bias in closed
+    form, regularized by reg_term * (number of reviews), over the
+    user-major (item-major) CSR rating matrix.  Rows are solved in blocks
+    of about block_reviews reviews with batched np.linalg.solve, spread
+    over njobs forked workers writing into shared memory.
+    """
+    def __init__(self, nusers, nitems):
+        super(ALSSVD, self).__init__(nusers, nitems)
+        self.reg_term = 0.1
+        self.max_train_iters = 10
+        self.block_reviews = 50000
+
+    def setup(self):
+        self.size = len(self.review_list)
+        self.uids, self.aids, self.ratings = review_arrays(self.review_list)
+        self.avg = self.avg_rating()
+
+        self.U = np.random.normal(0, self.initscale, [self.nusers, self.nfeats])
+        self.V = np.random.normal(0, self.initscale, [self.nitems, self.nfeats])
+        self.ubias = np.zeros(self.nusers)
+        self.abias = np.zeros(self.nitems)
+
+        self.by_user = sparse_ratings(self.uids, self.aids, self.ratings, self.nusers, self.nitems)
+        self.by_item = sparse_ratings(self.aids, self.uids, self.ratings, self.nitems, self.nusers)
+
+    def train(self, review_list):
+        self.review_list = review_list
+        self.setup()
+        if self.njobs > 1:
+            for name in ['U', 'V', 'ubias', 'abias']:
+                setattr(self, name, parallel.to_shared(getattr(self, name)))
+            self.pool = parallel.fork_pool(self.njobs, model=self)
+        try:
+            iter_error = float('inf')
+            for iters in range(self.max_train_iters):
+                self.als_half('user')
+                self.als_half('item')
+                rmse = round(self.get_rmse(), 3)
+                if self.verbose:
+                    print "sweep:{} train rmse: {:.3f}".format(iters+1, rmse)
+                if rmse >= iter_error:
+                    break
+                iter_error = rmse
+        finally:
+            if self.pool is not None:
+                parallel.close_pool(self.pool)
+                self.pool = None
+
+    def als_blocks(self, side):
+        """
+        (start, stop) row ranges holding about block_reviews reviews each
+        """
+        indptr = self.by_user.indptr if side == 'user' else self.by_item.indptr
+        nrows = len(indptr) - 1
+        targets = np.arange(self.block_reviews, indptr[-1], self.block_reviews)
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(indptr, targets), [nrows]]))
+        return [(side, int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def als_half(self, side):
+        blocks = self.als_blocks(side)
+        if self.pool is not None:
+            self.pool.map(_als_part, blocks)
+        else:
+            for block in blocks:
+                self.als_block(*block)
+
+    def als_block(self, side, start, stop):
+        """
+        Solves rows start:stop of U/ubias (side 'user') or V/abias ('item')
+        """
+        if side == 'user':
+            mat, rows, rbias, cols, cbias = self.by_user, self.U, self.ubias, self.V, self.abias
+        else:
+            mat, rows, rbias, cols, cbias = self.by_item, self.V, self.abias, self.U, self.ubias
+
+        idx, W = solve_rows(mat, start, stop, cols, cbias, self.avg, self.reg_term)
+        rows[idx] = W[:, :-1]
+        rbias[idx] = W[:, -1]
+
+
+def _als_part(block):
+    parallel.STATE['model'].als_block(*block)
+
+
+################# Neighbourhood Models #####################
+
+class ItemKNN(Model):
+    """
+    Item-based KNN on top of a baseline:
+
+        r = b(u,i) + sum_j s(i,j) z(u,j) / (damping + sum_j s(i,j))
+
+    with b(u,i) = avg + ubias[u] + abias[i] fitted in closed form
+    (baseline_iters alternating passes, regularized by reg_user/reg_item
+    pseudo counts), z the baseline residuals of the training reviews and
+    j running over the k most similar items to i that u rated.  damping
+    pulls predictions backed by only weak similarities to the baseline.
+
+    s is the Pearson correlation of the residuals over the users rating
+    both items, shrunk by (n-1)/(n-1+shrink) for n common users; only
+    positive similarities are kept.  Similarities are computed a block
+    of items at a time from sparse products of the item x user residual
+    matrix (neighbors.top_neighbors), spread over njobs forked workers,
+    and only the top nneighbors per item are cached.
+    """
+    dense_ids = True
+    param_attrs = ('ubias', 'abias', 'nbr_items', 'nbr_sims', 'resid_keys', 'resid')
+
+    def __init__(self):
+        super(ItemKNN, self).__init__()
+        self.k = 20
+        self.nneighbors = 50
+        self.shrink = 100.
+        self.damping = 0.5
+        self.reg_user = 10.
+        self.reg_item = 25.
+        self.baseline_iters = 3
+        self.block_items = 512
+        self.njobs = 1
+        self.pool = None
+
+    def train(self, review_list):
+        self.review_list = review_list
+        uids, aids, ratings = review_arrays(review_list)
+        self.nusers = int(uids.max()) + 1 if len(uids) else 0
+        self.nitems = int(aids.max()) + 1 if len(aids) else 0
+        self.fit_baseline(uids, aids, ratings)
+
+        z = ratings - self.baseline(uids, aids)
+        self.by_item = neighbors.average_matrix(aids, uids, z, (self.nitems, self.nusers))
+        self.rated = self.by_item.copy()
+        self.rated.data[:] = 1.
+        self.squared = self.by_item.multiply(self.by_item).tocsr()
+
+        # residuals in user-major order, looked up by user * nitems + item
+        by_user = self.by_item.T.tocsr()
+        by_user.sort_indices()
+        rows = np.repeat(np.arange(self.nusers, dtype=np.int64), np.diff(by_user.indptr))
+        self.resid_keys = rows * self.nitems + by_user.indices
+        self.resid = by_user.data
+
+        self.nbr_items, self.nbr_sims = self.neighbor_lists()
+        del self.by_item, self.rated, self.squared
+
+    def fit_baseline(self, uids, aids, ratings):
+        if hasattr(self.review_list, 'stats'):
+            stats = self.review_list.stats()
+            ucount = stats['user_counts'][:self.nusers] + self.reg_user
+            acount = stats['item_counts'][:self.nitems] + self.reg_item
+        else:
+            ucount = np.bincount(uids, minlength=self.nusers) + self.reg_user
+            acount = np.bincount(aids, minlength=self.nitems) + self.reg_item
+        self.avg = self.avg_rating()
+        self.ubias = np.zeros(self.nusers)
+        self.abias = np.zeros(self.nitems)
+        for iters in range(self.baseline_iters):
+            self.abias = np.bincount(aids, ratings - self.avg - self.ubias[uids], self.nitems) / acount
+            self.ubias = np.bincount(uids, ratings - self.avg - self.abias[aids], self.nusers) / ucount
+
+    def baseline(self, uids, aids):
+        return self.avg + gather(self.ubias, uids) + gather(self.abias, aids)
+
+    def similarity_block(self, rows):
+        """
+        Dense shrunk Pearson similarities of items rows against all items,
+        nan where there is no positive similarity
+        """
+        Z, B, Z2 = self.by_item, self.rated, self.squared
+        num = Z[rows].dot(Z.T).toarray()
+        common = B[rows].dot(B.T).toarray()
+        denom = np.sqrt(Z2[rows].dot(B.T).toarray() * B[rows].dot(Z2.T).toarray())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim = num / denom * (common - 1) / (common - 1 + self.shrink)
+            sim[~(sim > 0)] = np.nan
+        return sim
+
+    def neighbor_lists(self):
+        bounds = range(0, self.nitems, self.block_items) + [self.nitems]
+        blocks = zip(bounds[:-1], bounds[1:])
+        if self.njobs > 1:
+            self.pool = parallel.fork_pool(self.njobs, model=self)
+            try:
+                parts = self.pool.map(_knn_part, blocks)
+            finally:
+                parallel.close_pool(self.pool)
+                self.pool = None
+        else:
+            parts = [self.neighbor_block(start, stop) for start, stop in blocks]
+        if not parts:
+            return np.zeros([0, self.nneighbors], dtype=np.int64), np.zeros([0, self.nneighbors])
+        return np.vstack([p[0] for p in parts]), np.vstack([p[1] for p in parts])
+
+    def neighbor_block(self, start, stop):
+        return neighbors.top_neighbors(self.similarity_block, self.nitems, self.nneighbors,
+                                       np.arange(start, stop), self.block_items)
+
+    def predict(self, review):
+        return self.predict_many([review])[0]
+
+    def predict_many(self, review_list, chunk=20000):
+        uids, aids, _ = review_arrays(review_list)
+        uids = uids.astype(np.int64)
+        aids = aids.astype(np.int64)
+        pred = self.baseline(uids, aids)
+        for start in range(0, len(uids), chunk):
+            u = uids[start:start+chunk]
+            a = aids[start:start+chunk]
+            known = (u < self.nusers) & (a < self.nitems)
+            nbrs = np.where(known[:, None], self.nbr_items[np.where(known, a, 0)], -1)
+            sims = self.nbr_sims[np.where(known, a, 0)]
+
+            # residual of u on every neighbour, if u rated it
+            keys = u[:, None] * self.nitems + nbrs
+            pos = np.minimum(np.searchsorted(self.resid_keys, keys), len(self.resid_keys) - 1)
+            rated = (nbrs >= 0) & (self.resid_keys[pos] == keys)
+            # neighbour lists are sorted, so the first k rated are the top k
+            use = rated & (np.cumsum(rated, 1) <= self.k)
+            weights = np.where(use, sims, 0.)
+            total = weights.sum(1) + self.damping
+            num = (weights * self.resid[pos]).sum(1)
+            ok = total > 0
+            pred[start:start+chunk][ok] += num[ok] / total[ok]
+        return self.proper_rating(pred)
+
+
+def _knn_part(block):
+    return parallel.STATE['model'].neighbor_block(*block)
@@ -0,0 +1,222 @@
+"""
+Item-item neighbour lists.
+
+Similarities are computed a block of items at a time as matrix products
+(dense for factor vectors, sparse for the item x user rating matrix), so
+memory stays O(block * nitems) and no pair is visited in python.  Only
+the top n neighbours of each item are kept.
+
+NeighborIndex stores those lists as dense (nitems, n) arrays keyed by the
+raw aid, so a lookup is one dict access plus a row slice, and can be
+saved, memory mapped and updated for a few changed items.
+"""
+
+import os
+import json
+import numpy as np
+import scipy.sparse as sp
+from helper import IdMap, write_dir
+from retrieval import top_k
+
+
+def average_matrix(rows, cols, values, shape):
+    """
+    CSR matrix of values, averaging repeated (row, col) entries.
+    Indices come out sorted within each row.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    mat = sp.coo_matrix((values, (rows, cols)), shape=shape).tocsr()
+    counts = sp.coo_matrix((np.ones(len(values)), (rows, cols)), shape=shape).tocsr()
+    mat.data /= counts.data
+    return mat
+
+
+def item_ratings(data, nitems=None):
+    """
+    CSR item x user matrix of the ratings in a ReviewData.  Repeated
+    (user, item) reviews are averaged.
+    """
+    nitems = nitems or data.nitems
+    return average_matrix(data.aid, data.uid, data.rating, (nitems, data.nusers))
+
+
+def normalize_rows(X):
+    """
+    X with unit length rows (zero rows stay zero), dense or CSR
+    """
+    if sp.issparse(X):
+        norms = np.sqrt(np.asarray(X.multiply(X).sum(1)).ravel())
+        norms[norms == 0] = 1.
+        return sp.diags(1. / norms).dot(X).tocsr()
+    norms = np.sqrt((X**2).sum(1))
+    norms[norms == 0] = 1.
+    return X / norms[:, None]
+
+
+def cosine_block(X, rows, cols=None):
+    """
+    Dense (len(rows), len(cols)) cosine similarities between rows of the
+    row normalized matrix X
+    """
+    other = X if cols is None else X[cols]
+    block = X[rows].dot(other.T)
+    if sp.issparse(block):
+        block = block.toarray()
+    return np.asarray(block)
+
+
+def top_neighbors(sim_block, nitems, n, rows=None, block=1024):
+    """
+    Top n neighbours of each item in rows (default all), excluding the
+    item itself.  sim_block(rows) returns the dense similarities of rows
+    against all nitems items.  Returns (items, sims) of shape
+    (len(rows), n), padded with -1 / -inf; pairs with no similarity
+    (nan or -inf) are left out.
+    """
+    if rows is None:
+        rows = np.arange(nitems)
+    rows = np.asarray(rows, dtype=np.int64)
+    items = np.empty([len(rows), n], dtype=np.int64)
+    items.fill(-1)
+    sims = np.empty([len(rows), n])
+    sims.fill(-np.inf)
+    for start in range(0, len(rows), block):
+        chunk = rows[start:start+block]
+        scores = sim_block(chunk)
+        scores[np.isnan(scores)] = -np.inf
+        scores[np.arange(len(chunk)), chunk] = -np.inf
+        idx, best = top_k(scores, n)
+        ok = np.isfinite(best)
+        width = idx.shape[1]
+        items[start:start+len(chunk), :width] = np.where(ok, idx, -1)
+        sims[start:start+len(chunk), :width] = np.where(ok, best, -np.inf)
+    return items, sims
+
+
+class NeighborIndex(object):
+    """
+    Top n most similar items per aid.
+
+    source is 'factors' (cosine between rows of an item factor matrix
+    such as SVD.V) or 'ratings' (cosine between items over the users who
+    rated them).  fit/update take the matching input: the factor matrix
+    or a ReviewData.  keys are the raw aids of the rows; for 'ratings'
+    they default to the data's aid map.
+    """
+    def __init__(self, n=20, source='factors', block=1024):
+        if source not in ('factors', 'ratings'):
+            raise ValueError("unknown source '{}'".format(source))
+        self.n = n
+        self.source = source
+        self.block = block
+        self.keys = IdMap()
+        self.items = np.zeros([0, n], dtype=np.int64)
+        self.sims = np.zeros([0, n])
+
+    def matrix(self, src, nitems):
+        if self.source == 'factors':
+            return normalize_rows(np.asarray(src, dtype=np.float64)[:nitems])
+        return normalize_rows(item_ratings(src, nitems))
+
+    def set_keys(self, src, keys):
+        if keys is None:
+            if self.source == 'factors':
+                raise ValueError("keys are needed for source 'factors'")
+            keys = src.maps['aid'].keys
+        for key in keys:
+            self.keys.add(key)
+        return len(self.keys)
+
+    def fit(self, src, keys=None):
+        self.keys = IdMap()
+        nitems = self.set_keys(src, keys)
+        X = self.matrix(src, nitems)
+        self.items, self.sims = top_neighbors(
+            lambda rows: cosine_block(X, rows), nitems, self.n, block=self.block)
+        return self
+
+    def update(self, src, changed, keys=None):
+        """
+        Refreshes the lists after the vectors (or ratings) of the items
+        in changed (raw aids) changed; new keys count as changed.  Only
+        the changed items' rows are recomputed in full.  Other rows drop
+        their stale entries and merge in the new similarities to the
+        changed items, which is exact unless a row lost an entry it can't
+        refill, in which case it is recomputed too.
+        """
+        old = len(self.keys)
+        nitems = self.set_keys(src, keys)
+        changed = set(self.keys.get(key) for key in changed) - set([-1])
+        changed = np.array(sorted(changed | set(range(old, nitems))), dtype=np.int64)
+        if not len(changed):
+            return self
+        X = self.matrix(src, nitems)
+        sim_block = lambda rows: cosine_block(X, rows)
+
+        items = np.empty([nitems, self.n], dtype=np.int64)
+        items.fill(-1)
+        sims = np.empty([nitems, self.n])
+        sims.fill(-np.inf)
+        items[:old] = self.items
+        sims[:old] = self.sims
+
+        is_changed = np.zeros(nitems, dtype=bool)
+        is_changed[changed] = True
+        stale = (items >= 0) & is_changed[np.maximum(items, 0)]
+        items[stale] = -1
+        sims[stale] = -np.inf
+        kept = (items >= 0).sum(1)
+        full = np.zeros(nitems, dtype=bool)
+        full[changed] = True
+        # a row that lost entries could be missing an unchanged item
+        # ranked just below its old list
+        full |= (kept < self.n) & (kept < nitems - 1 - len(changed)) & stale.any(1)
+
+        rest = np.nonzero(~full)[0]
+        for start in range(0, len(rest), self.block):
+            chunk = rest[start:start+self.block]
+            scores = cosine_block(X, chunk, changed)
+            scores[chunk[:, None] == changed[None, :]] = -np.inf
+            scores[np.isnan(scores)] = -np.inf
+            cand_items = np.hstack([items[chunk], np.tile(changed, (len(chunk), 1))])
+            cand_sims = np.hstack([sims[chunk], scores])
+            idx, best = top_k(cand_sims, self.n)
+            rows = np.arange(len(chunk))[:, None]
+            ok = np.isfinite(best)
+            width = idx.shape[1]
+            items[chunk, :width] = np.where(ok, cand_items[rows, idx], -1)
+            sims[chunk, :width] = np.where(ok, best, -np.inf)
+
+        redo = np.nonzero(full)[0]
+        items[redo], sims[redo] = top_neighbors(sim_block, nitems, self.n, redo, self.block)
+        self.items, self.sims = items, sims
+        return self
+
+    def neighbors(self, aid):
+        """
+        (aids, similarities) of the neighbours of aid, most similar first
+        """
+        i = self.keys.get(aid)
+        if i < 0:
+            return [], np.zeros(0)
+        row = self.items[i]
+        row = row[row >= 0]
+        return [self.keys.keys[j] for j in row], np.asarray(self.sims[i, :len(row)])
+
+    def save(self, dirname):
+        """
+        Writes items/sims as .npy plus the keys and settings as json (see
+        helper.write_dir)
+        """
+        meta = {'n': self.n, 'source': self.source, 'block': self.block, 'keys': self.keys.keys}
+        write_dir(dirname, {'items': self.items, 'sims': self.sims}, {'meta': meta})
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls(meta['n'], meta['source'], meta['block'])
+        index.keys = IdMap(meta['keys'])
+        index.items = np.load(os.path.join(dirname, 'items.npy'), mmap_mode=mmap_mode)
+        index.sims = np.load(os.path.join(dirname, 'sims.npy'), mmap_mode=mmap_mode)
+        return index
@@ -0,0 +1,48 @@
+"""
+Helpers for process-parallel training over shared memory.
+
+Workers are forked, so whatever is put in STATE before the pool is
+created is inherited without pickling, and arrays made by shared_array
+are written through by every process.
+"""
+
+import multiprocessing as mp
+import numpy as np
+
+STATE = {}
+
+
+def shared_array(shape, dtype=np.float64):
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buf = mp.RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+
+def to_shared(arr):
+    out = shared_array(arr.shape, arr.dtype)
+    out[...] = arr
+    return out
+
+
+def fork_pool(njobs, **state):
+    """
+    Pool of njobs forked workers that see state through parallel.STATE
+    """
+    STATE.clear()
+    STATE.update(state)
+    return mp.Pool(njobs)
+
+
+def close_pool(pool):
+    pool.close()
+    pool.join()
+    STATE.clear()
+
+
+def chunks(n, nparts):
+    """
+    (start, stop) bounds splitting range(n) into nparts contiguous pieces
+    """
+    bounds = np.linspace(0, n, nparts + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
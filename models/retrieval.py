@@ -0,0 +1,86 @@
+"""
+Top-K retrieval over item factors for SVD.recommend.
+
+top_k picks the k best columns of a score matrix with argpartition.
+FactorIndex is an approximate inverted file index for maximum inner
+product search: items are clustered with k-means and a query only scores
+the items in the nprobe clusters whose centroids score best against it.
+"""
+
+import numpy as np
+
+
+def top_k(scores, k):
+    """
+    (columns, scores) of the k largest entries of each row, best first
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+    rows = np.arange(len(scores))[:, None]
+    part = scores[rows, idx]
+    order = np.argsort(-part, axis=1, kind='mergesort')
+    return idx[rows, order], part[rows, order]
+
+
+def kmeans(X, nclusters, iters=10, seed=0):
+    """
+    Lloyd's k-means; returns (centroids, assignment)
+    """
+    rng = np.random.RandomState(seed)
+    centroids = X[rng.choice(len(X), nclusters, replace=False)].copy()
+    sqnorm = (X**2).sum(1)
+    for i in range(iters):
+        dist = sqnorm[:, None] - 2 * X.dot(centroids.T) + (centroids**2).sum(1)
+        assign = dist.argmin(1)
+        counts = np.bincount(assign, minlength=nclusters)
+        for f in range(X.shape[1]):
+            sums = np.bincount(assign, weights=X[:, f], minlength=nclusters)
+            nonempty = counts > 0
+            centroids[nonempty, f] = sums[nonempty] / counts[nonempty]
+    return centroids, assign
+
+
+class FactorIndex(object):
+    """
+    Inverted file over item vectors.  vectors holds one row per item,
+    queries are scored by inner product against them.  nlist defaults
+    to about sqrt(nitems) clusters.
+    """
+    def __init__(self, vectors, nlist=None, nprobe=8, seed=0):
+        nitems = len(vectors)
+        if nlist is None:
+            nlist = max(1, int(np.sqrt(nitems)))
+        nlist = min(nlist, nitems)
+        self.vectors = vectors
+        self.nprobe = nprobe
+        self.centroids, assign = kmeans(vectors, nlist, seed=seed)
+        # items grouped by cluster: cluster c holds items[ptr[c]:ptr[c+1]]
+        self.items = np.argsort(assign, kind='mergesort')
+        self.ptr = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=self.ptr[1:])
+
+    def candidates(self, query, allowed=None):
+        """
+        Item indices in the nprobe best clusters for one query vector,
+        restricted to items where the boolean mask allowed is True
+        """
+        nprobe = min(self.nprobe, len(self.centroids))
+        best = np.argpartition(-self.centroids.dot(query), nprobe - 1)[:nprobe]
+        items = np.concatenate([self.items[self.ptr[c]:self.ptr[c+1]] for c in best])
+        if allowed is not None:
+            items = items[allowed[items]]
+        return items
+
+    def search(self, query, k, allowed=None):
+        """
+        (items, scores) of the approximate top k for one query vector
+        """
+        items = self.candidates(query, allowed)
+        if not len(items):
+            return items, np.zeros(0)
+        scores = self.vectors[items].dot(query)
+        idx, best = top_k(scores[None, :], k)
+        return items[idx[0]], best[0]
@@ -0,0 +1,364 @@
+"""
+Local prediction server for a model written by Model.save.  Run as
+
+    python server.py modeldir [port]          serve on localhost
+    python server.py modeldir --bench         serve and run a load test
+
+POST /predict takes a json query {"uid":..., "aid":..., "lang":...,
+"date": "2014-06-30"} (country, location and kgroup, a list of the
+item's group codes, optional) or a list of them and returns the
+predicted ratings.  GET /stats reports the request count,
+mean batch size, p50/p99 latency and throughput.
+
+Requests are queued and a single batcher thread drains the queue into
+micro-batches of up to max_batch queries, waiting at most max_wait
+seconds after the first one, so concurrent requests share one vectorized
+predict_many call.
+"""
+
+import sys
+import json
+import socket
+import httplib
+import threading
+import Queue
+import numpy as np
+from time import time
+from datetime import date
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from helper import IdMap, ReviewData, DateDecoder
+from models import load_model
+
+
+ID_COLUMNS = ['uid', 'aid', 'lang', 'country', 'location']
+
+
+def check_queries(queries, decoder):
+    """
+    Raises ValueError if a query can't be scored.  Decoding the dates here
+    also fills decoder's memo for query_data.
+    """
+    for query in queries:
+        if not isinstance(query, dict):
+            raise ValueError('a query must be a json object')
+        for col in ID_COLUMNS:
+            key = query.get(col)
+            if key is not None and not isinstance(key, (basestring, int, long)):
+                raise ValueError('{} must be a string or an integer'.format(col))
+        day = query.get('date')
+        if day is not None and not isinstance(day, basestring):
+            raise ValueError('date must be a string')
+        kgroup = query.get('kgroup') or []
+        if not isinstance(kgroup, list) or not all(
+                isinstance(x, int) and 0 <= x < 128 for x in kgroup):
+            raise ValueError('kgroup must be a list of small integers')
+    today = date.today().isoformat()
+    for day in set(query.get('date') or today for query in queries):
+        try:
+            decoder([day])
+        except Exception:
+            raise ValueError("can't decode date {!r}".format(day))
+
+
+def query_data(queries, model, decoder):
+    """
+    ReviewData for a list of query dicts.  The maps only hold the ids in
+    the batch, except uid/aid for the models with dense_ids (SVD, ItemKNN)
+    which index their parameters by the training maps; ids unseen in
+    training get an index past the end there and so predict from the
+    biases alone.
+    """
+    n = len(queries)
+    maps = dict((name, IdMap()) for name in ReviewData.map_names)
+    cols = {}
+    trained = model.id_maps()
+    for col in ID_COLUMNS:
+        ids = [query.get(col) for query in queries]
+        if model.dense_ids and col in ('uid', 'aid') and trained:
+            idx = trained[col].lookup(ids)
+            idx[idx < 0] = len(trained[col])
+            cols[col] = idx
+        else:
+            cols[col] = np.array([maps[col].add(key) for key in ids], dtype=np.int64)
+    today = date.today().isoformat()
+    days, years, months = decoder([query.get('date') or today for query in queries])
+    cols['date'] = days
+    cols['year'] = years
+    cols['month'] = months
+    cols['rating'] = np.zeros(n, dtype=np.float32)
+    # wide enough for the group column the group models read
+    group = getattr(model, 'group', None)
+    width = max([len(query.get('kgroup') or []) for query in queries] +
+                [0 if group is None else group + 1])
+    cols['kgroup'] = np.zeros([n, width], dtype=np.int8)
+    for i, query in enumerate(queries):
+        kgroup = query.get('kgroup') or []
+        cols['kgroup'][i, :len(kgroup)] = kgroup
+    return ReviewData(cols, maps)
+
+
+class Stats(object):
+    """
+    Latencies and completion times of the last window requests plus
+    running totals.  Throughput is measured over that window, so time
+    the server sat idle before it doesn't count.
+    """
+    def __init__(self, window=100000):
+        self.lock = threading.Lock()
+        self.latency = np.zeros(window)
+        self.finished = np.zeros(window)
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.batches = 0
+
+    def add(self, latencies):
+        now = time()
+        with self.lock:
+            for lat in latencies:
+                self.latency[self.count % self.window] = lat
+                self.finished[self.count % self.window] = now
+                self.count += 1
+            self.batches += 1
+
+    def report(self):
+        with self.lock:
+            n = min(self.count, self.window)
+            recent = self.latency[:n]
+            # requests per second between the first and the last request
+            # in the window, counting the first one's latency in the span
+            out = {'requests': self.count,
+                   'batches': self.batches,
+                   'mean_batch': self.count / float(max(self.batches, 1)),
+                   'throughput': 0.}
+            if n:
+                first = np.argmin(self.finished[:n])
+                span = self.finished[:n].max() - self.finished[first] + self.latency[first]
+                if span > 0:
+                    out['throughput'] = n / span
+            if len(recent):
+                out['p50_ms'] = np.percentile(recent, 50) * 1000
+                out['p99_ms'] = np.percentile(recent, 99) * 1000
+            return out
+
+
+class Batcher(object):
+    """
+    Collects queries from the handler threads and answers them in batches
+    """
+    def __init__(self, model, max_batch=256, max_wait=0.002):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue.Queue()
+        self.stats = Stats()
+        self.decoder = DateDecoder()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def predict(self, queries):
+        """
+        Blocks until the batcher has scored queries; called per request
+        """
+        job = {'queries': queries, 'done': threading.Event(), 't0': time()}
+        self.queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise ValueError(job['error'])
+        return job['result']
+
+    def next_batch(self):
+        jobs = [self.queue.get()]
+        size = len(jobs[0]['queries'])
+        deadline = time() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                job = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            jobs.append(job)
+            size += len(job['queries'])
+        return jobs
+
+    def fail(self, jobs, error):
+        for job in jobs:
+            job['error'] = error
+            job['done'].set()
+
+    def run(self):
+        # nothing may end this loop: the handlers wait on it forever
+        while True:
+            jobs = []
+            try:
+                jobs = self.next_batch()
+                self.answer(jobs)
+            except Exception as e:
+                self.fail([job for job in jobs if not job['done'].is_set()], str(e))
+
+    def answer(self, jobs):
+        # a bad query only fails its own request, not the whole batch
+        good = []
+        for job in jobs:
+            try:
+                check_queries(job['queries'], self.decoder)
+            except ValueError as e:
+                self.fail([job], str(e))
+                continue
+            good.append(job)
+        if not good:
+            return
+        queries = [query for job in good for query in job['queries']]
+        data = query_data(queries, self.model, self.decoder)
+        preds = self.model.predict_many(data).tolist()
+        start = 0
+        now = time()
+        for job in good:
+            stop = start + len(job['queries'])
+            job['result'] = preds[start:stop]
+            start = stop
+            job['done'].set()
+        self.stats.add([now - job['t0'] for job in good])
+
+
+def no_delay(sock):
+    # headers and body go out in separate writes; without this Nagle's
+    # algorithm holds the body back until the peer's delayed ack (~40ms)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        no_delay(self.connection)
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.reply(404, {'error': 'unknown path'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        except (TypeError, ValueError):
+            return self.reply(400, {'error': 'bad json'})
+        single = isinstance(body, dict)
+        queries = [body] if single else body
+        if not isinstance(queries, list) or not all(isinstance(q, dict) for q in queries):
+            return self.reply(400, {'error': 'expected a query object or a list of them'})
+        if not queries:
+            return self.reply(200, [])
+        try:
+            preds = self.server.batcher.predict(queries)
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(200, preds[0] if single else preds)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': 'unknown path'})
+        self.reply(200, self.server.batcher.stats.report())
+
+    def reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PredictionServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, model, port=8000, max_batch=256, max_wait=0.002):
+        if model.dense_ids and not model.id_maps():
+            # per-batch indices would pick arbitrary users/items
+            raise ValueError("{} indexes users/items by the training id maps; train it on "
+                             "a ReviewData so they are saved".format(type(model).__name__))
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.batcher = Batcher(model, max_batch, max_wait)
+
+    def start(self):
+        """
+        Serves from a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def load_test(port, queries, nclients=16, nrequests=2000):
+    """
+    nclients threads with a keep-alive connection each send nrequests
+    single-query requests in total.  Prints client side p50/p99 latency
+    and throughput.
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def client(offset):
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.connect()
+        no_delay(conn.sock)
+        mine = []
+        for i in range(offset, nrequests, nclients):
+            body = json.dumps(queries[i % len(queries)])
+            t = time()
+            conn.request('POST', '/predict', body, {'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            mine.append(time() - t)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    t0 = time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(nclients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - t0
+    print "{} clients, {} requests".format(nclients, nrequests)
+    print "p50 {:.2f}ms  p99 {:.2f}ms  {:,.0f} requests/sec".format(
+        np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000,
+        len(latencies) / elapsed)
+
+
+def sample_queries(model, n=1000, seed=0):
+    """
+    Queries over the users/items in the model's id maps
+    """
+    rng = np.random.RandomState(seed)
+    maps = model.id_maps()
+    uids = maps['uid'].keys
+    aids = maps['aid'].keys
+    langs = [lang for lang in maps['lang'].keys if lang is not None] or ['en']
+    return [{'uid': uids[rng.randint(len(uids))], 'aid': aids[rng.randint(len(aids))],
+             'lang': langs[rng.randint(len(langs))], 'date': '2014-06-30'}
+            for i in range(n)]
+
+
+if __name__ == '__main__':
+    model = load_model(sys.argv[1])
+    port = 8000
+    if len(sys.argv) > 2 and sys.argv[2] != '--bench':
+        port = int(sys.argv[2])
+    server = PredictionServer(model, port)
+    if '--bench' in sys.argv:
+        server.start()
+        load_test(port, sample_queries(model))
+        print "server:", server.batcher.stats.report()
+    else:
+        print "serving on 127.0.0.1:{}".format(port)
+        server.serve_forever()
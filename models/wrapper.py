@@ -11,10 +11,14 @@ from numpy import log10
 import sys
 import random
 from time import time, sleep
-from helper import Parse, Review
+from helper import Parse, Review, ReviewData, Folds, create_indexes
 from models import *
+import parallel
 from itertools import product, izip
 import json
+import os
+import copy
+import hashlib
 import pdb
 import pickle
 import sqlite3
@@ -23,7 +27,166 @@ from sklearn import cross_validation
 from math import log10, floor
 
 
+def param_key(attrdict):
+    """
+    Canonical json string of a parameter combination, sorted by name
+    """
+    return json.dumps(sorted(attrdict.items()))
+
+
+class ResultStore(object):
+    """
+    Append-only JSONL file of search results, one
+    {"params": {...}, "result": ...} object per line, read back into a
+    dict keyed by param_key.  Lines are flushed and fsynced as they are
+    written, so a killed run loses at most the line being written; a
+    truncated last line is ignored on load.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().split('\n')
+            for line in lines:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                self.results[param_key(rec['params'])] = rec['result']
+            if lines[-1]:
+                # end the torn line so the next record starts on its own
+                with open(path, 'a') as f:
+                    f.write('\n')
+
+    def __contains__(self, attrdict):
+        return param_key(attrdict) in self.results
+
+    def get(self, attrdict, default=None):
+        return self.results.get(param_key(attrdict), default)
+
+    def add(self, attrdict, result):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'params': attrdict, 'result': result}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.results[param_key(attrdict)] = result
+
+
+def check_nested(model, njobs):
+    """
+    Raises ValueError if model would fork workers inside the njobs pool
+    workers, which are daemonic and can't have children
+    """
+    if njobs > 1 and getattr(model, 'njobs', 1) > 1:
+        raise ValueError("model.njobs and ModelWrapper.njobs can't both be > 1")
+
+
+def warm_startable(model):
+    """
+    True if model.partial_fit on its own training data continues
+    training for more epochs.  This approximates a longer cold run
+    rather than reproducing it: halving_search reseeds the shuffling per
+    rung, the sgd early stop restarts in every partial_fit and joint SVD
+    also restarts its visiting order.
+    """
+    if isinstance(model, ALSSVD):
+        return False
+    if isinstance(model, SVD):
+        return model.joint
+    if isinstance(model, BaseModel):
+        return model.solver != 'als' and not model.valid_frac
+    return False
+
+
+# settings left out of the cache key: values computed by training and
+# sizes that follow from the data
+FITTED = set(['avg', 'initval', 'epoch_err', 'valid_rmse', 'nusers', 'nitems'])
+
+
+def key_value(value):
+    """
+    value as plain json types: arrays and numpy scalars become lists and
+    numbers, sets sorted {'__set__': [...]} so equal settings give equal
+    json.  Raises TypeError for anything else.
+    """
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': sorted(key_value(x) for x in value)}
+    if isinstance(value, (list, tuple)):
+        return [key_value(x) for x in value]
+    if isinstance(value, dict):
+        return dict((str(k), key_value(v)) for k, v in value.iteritems())
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    raise TypeError("can't use {!r} in a cache key".format(type(value)))
+
+
+def cache_params(model):
+    """
+    Every setting of model, which together determine its CV results, or
+    None if one of them can't be written as json (the run is then not
+    cached rather than sharing a key with different settings)
+    """
+    params = {}
+    for name, value in model.__dict__.iteritems():
+        if name in NOT_PARAMS or name in FITTED or name in model.param_attrs:
+            continue
+        try:
+            params[name] = key_value(value)
+        except TypeError:
+            return None
+    return params
+
+
+def data_fingerprint(review_list):
+    """
+    sha1 of the reviews.  For Review objects every field is hashed, since
+    models read different ones (kgroup, tags, country, ...).
+    """
+    if isinstance(review_list, ReviewData):
+        return review_list.fingerprint()
+    sha = hashlib.sha1()
+    for review in review_list:
+        sha.update(repr(sorted(review.__dict__.iteritems())))
+    return sha.hexdigest()
+
+
+def configure(model, attrdict):
+    """
+    Shallow copy of model with the attributes in attrdict set
+    """
+    model = copy.copy(model)
+    for name, value in attrdict.iteritems():
+        setattr(model, name, value)
+    return model
+
+
 class ModelWrapper(object):
+    """
+    K-fold cross validation of a model over review_list.
+
+    With njobs > 1 the folds run in a pool of forked workers: each worker
+    trains its own copy-on-write copy of the model and reads the reviews
+    inherited from the parent (memory mapped when they come from the
+    Parse cache), so nothing is pickled but the fold number and the
+    errors.  Every fold seeds numpy/random with SEED + fold, so results
+    do not depend on njobs.
+
+    For a ReviewData the folds are helper.Folds views, built once and
+    kept across start() calls together with their training statistics,
+    so evaluating another model on the same folds copies no data.
+
+    With cache_dir set, start() stores its results in cache_dir keyed by
+    a hash of the model class, cache_params(model), the data fingerprint,
+    n_folds, fold_seed and SEED, and returns them from there when the
+    same experiment is run again.  A model with a setting that can't be
+    written as json is not cached.  keep_oof also keeps the out-of-fold
+    predictions (self.oof, aligned with review_list) and caches them.
+    """
     def __init__(self, review_list):
         self.cv_iters = 1
         self.SEED = 1000
@@ -31,55 +194,359 @@ class ModelWrapper(object):
         self.test_size = 0.2
         self.review_list = review_list
         self.save_file = None
+        self.n_folds = 5
+        self.njobs = 1
+        self.verbose_folds = True
+        self.fold_results = []
+        self.cv_folds = None
+        self.cv_folds_args = None
+        self.fold_seed = 0
+        self.cache_dir = None
+        self.keep_oof = False
+        self.oof = None
+        self.fingerprint = None
 
     def get_ratings(self, mylist):
+        if isinstance(mylist, ReviewData):
+            return mylist.rating
         return [review.rating for review in mylist]
 
+    def subset(self, idx):
+        if isinstance(self.review_list, ReviewData):
+            return self.review_list.take(idx)
+        return [ self.review_list[i] for i in idx ]
+
     def attr_combs(self, dicts):
         return (dict(izip(dicts, x)) for x in product(*dicts.itervalues()))
 
-    def param_search(self, model, params):
-        #Params are in dict format {'a':[1,2,3], 'b':range(40,45), 'c':range(5,9)}
-        
-        varspace = [len(x) for x in params.values()] 
-        data = np.empty(varspace)
-        for attrdict in self.attr_combs(params):
-            indices = [0] * len(params)
-            for param_name, value in attrdict.iteritems():
-                model.__dict__[param_name] = value
-                param_loc = params.keys().index(param_name)
-                indices[param_loc] = params[param_name].index(value)
-
-            print "\nparameters: ", attrdict
-            data[tuple(indices)] = self.start(model)
-
-            with open(self.save_file,'w') as f:    
-                np.save(f, data)
-
+    def param_search(self, model, params, njobs=1):
+        """
+        Grid search over params, a dict like {'a':[1,2,3], 'b':range(40,45)}.
+        Each combination is cross validated on a copy of model and its
+        test error appended to the ResultStore at self.save_file (if
+        set); combinations already in the store are skipped, so a killed
+        search resumes where it stopped.  With njobs > 1 combinations run
+        in forked workers (their folds serially).  Returns the errors as
+        an array with one axis per parameter, in params order.
+        """
+        names = params.keys()
+        store = ResultStore(self.save_file) if self.save_file else None
+        combs = list(self.attr_combs(params))
+        todo = [attrdict for attrdict in combs if store is None or attrdict not in store]
+        if store is not None and len(todo) < len(combs):
+            print "resuming: {} of {} combinations done".format(len(combs) - len(todo), len(combs))
+
+        results = {}
+        if njobs > 1 and todo:
+            for attrdict in todo:
+                check_nested(configure(model, attrdict), njobs)
+            # built before forking so the workers share them
+            self.prepare_folds()
+            pool = parallel.fork_pool(njobs, wrapper=self, model=model)
+            try:
+                for attrdict, err in pool.imap_unordered(_grid_part, todo):
+                    print "parameters: {} test error: {}".format(attrdict, err)
+                    results[param_key(attrdict)] = err
+                    if store is not None:
+                        store.add(attrdict, err)
+            finally:
+                parallel.close_pool(pool)
+        else:
+            for attrdict in todo:
+                print "\nparameters: ", attrdict
+                err = self.start(configure(model, attrdict))
+                results[param_key(attrdict)] = err
+                if store is not None:
+                    store.add(attrdict, err)
+
+        data = np.empty([len(params[name]) for name in names])
+        data.fill(np.nan)
+        for attrdict in combs:
+            key = param_key(attrdict)
+            err = results[key] if key in results else store.get(attrdict)
+            indices = tuple(params[name].index(attrdict[name]) for name in names)
+            data[indices] = np.nan if err is None else err
         return data
     
+    def folds(self):
+        """
+        helper.Folds for a ReviewData, else the list of KFold index pairs
+        """
+        if self.cv_folds is None or self.cv_folds_args != (self.n_folds, self.fold_seed):
+            if isinstance(self.review_list, ReviewData):
+                self.cv_folds = Folds(self.review_list, self.n_folds, seed=self.fold_seed)
+            else:
+                kf = cross_validation.KFold(len(self.review_list), n_folds=self.n_folds, shuffle=True, random_state = self.fold_seed)
+                self.cv_folds = list(kf)
+            self.cv_folds_args = (self.n_folds, self.fold_seed)
+        return self.cv_folds
+
+    def prepare_folds(self):
+        """
+        The folds with their layout and training statistics built, so
+        forked workers inherit them instead of building their own
+        """
+        folds = self.folds()
+        if isinstance(folds, Folds):
+            folds.arrange()
+            for fold in range(len(folds)):
+                folds.stats(fold)
+        return folds
+
+    def test_indices(self, fold):
+        folds = self.folds()
+        if isinstance(folds, Folds):
+            return folds.indices(fold)[1]
+        return folds[fold][1]
+
+    def split(self, fold):
+        """
+        (train, test) data of a fold
+        """
+        folds = self.folds()
+        if isinstance(folds, Folds):
+            return folds.split(fold)
+        train_idx, test_idx = folds[fold]
+        return self.subset(train_idx), self.subset(test_idx)
+
+    def run_fold(self, model, fold):
+        """
+        Trains model on one fold; returns (train rmse, test rmse, seconds,
+        test predictions if keep_oof else None)
+        """
+        t0 = time()
+        np.random.seed(self.SEED + fold)
+        random.seed(self.SEED + fold)
+        train_list, test_list = self.split(fold)
+        model.train(train_list)
+        train_err = model.get_rmse()
+        preds = model.predict_many(test_list)
+        test_err = np.sqrt(np.mean((preds - self.get_ratings(test_list))**2))
+        return train_err, test_err, time() - t0, preds if self.keep_oof else None
+
+    ############# result cache ####################
+
+    def cache_key(self, model):
+        """
+        (sha1 key, json key material) of a start() run of model, or
+        (None, None) if its settings can't be part of a key
+        """
+        params = cache_params(model)
+        if params is None:
+            return None, None
+        if self.fingerprint is None:
+            self.fingerprint = data_fingerprint(self.review_list)
+        material = {'class': type(model).__name__, 'params': params,
+                    'data': self.fingerprint, 'n_folds': self.n_folds,
+                    'fold_seed': self.fold_seed, 'seed': self.SEED}
+        material = json.dumps(material, sort_keys=True)
+        return hashlib.sha1(material).hexdigest(), material
+
+    def load_cached(self, key):
+        path = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.exists(path):
+            return None
+        oofname = os.path.join(self.cache_dir, key + '.oof.npy')
+        if self.keep_oof and not os.path.exists(oofname):
+            return None
+        with open(path) as f:
+            cached = json.load(f)
+        if self.keep_oof:
+            cached['oof'] = np.load(oofname, mmap_mode='r')
+        return cached
+
+    def save_cached(self, key, material, test_err, train_err):
+        """
+        Writes the results of the last start(); files are written under
+        a temporary name and renamed, so readers never see partial files
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        base = os.path.join(self.cache_dir, key)
+        tmp = '.tmp{}'.format(os.getpid())
+        if self.oof is not None:
+            with open(base + tmp, 'wb') as f:
+                np.save(f, self.oof)
+            os.rename(base + tmp, base + '.oof.npy')
+        with open(base + tmp, 'w') as f:
+            json.dump({'key': json.loads(material), 'test_err': test_err,
+                       'train_err': train_err, 'fold_results': self.fold_results}, f)
+        os.rename(base + tmp, base + '.json')
+
     def start(self, model):
         print model.__class__
-        mean_error = 0.
-        train_error = 0.
         t0 = time()
-        
-        kf = cross_validation.KFold(len(self.review_list), n_folds=5, shuffle=True, random_state = 0)
-
-        for train_idx, test_idx in kf:
-            test_list = [ self.review_list[idx] for idx in test_idx ]
-            train_list = [ self.review_list[idx] for idx in train_idx ]
-
-            model.train(train_list)
-            train_error += model.get_rmse()
-            mean_error += model.test(test_list)
-    
-        test_err = mean_error/5
-        train_err = train_error/5
+        key = None
+        if self.cache_dir:
+            key, material = self.cache_key(model)
+            cached = self.load_cached(key) if key else None
+            if cached is not None:
+                self.fold_results = [tuple(r) for r in cached['fold_results']]
+                self.oof = cached.get('oof')
+                print 'test error: {}, train error {:.3f}, cached'.format(cached['test_err'], cached['train_err'])
+                return cached['test_err']
+
+        nfolds = len(self.prepare_folds())
+        if self.njobs > 1:
+            check_nested(model, self.njobs)
+            pool = parallel.fork_pool(self.njobs, wrapper=self, model=model)
+            try:
+                results = pool.map(_fold_part, range(nfolds), 1)
+            finally:
+                parallel.close_pool(pool)
+        else:
+            results = [self.run_fold(model, fold) for fold in range(nfolds)]
+
+        self.fold_results = [tuple(float(x) for x in r[:3]) for r in results]
+        self.oof = None
+        if self.keep_oof:
+            self.oof = np.empty(len(self.review_list))
+            for fold, r in enumerate(results):
+                self.oof[self.test_indices(fold)] = r[3]
+        if self.verbose_folds:
+            for fold, (train_err, test_err, secs) in enumerate(self.fold_results):
+                print 'fold {}: test error {:.4f}, train error {:.4f}, time {:.1f}secs'.format(
+                    fold+1, test_err, train_err, secs)
+        test_err = float(np.mean([r[1] for r in self.fold_results]))
+        train_err = float(np.mean([r[0] for r in self.fold_results]))
         print 'test error: {}, train error {:.3f}, time {:.2f}mins'.format(test_err, train_err, (time()-t0)/60)
+        if key is not None:
+            self.save_cached(key, material, test_err, train_err)
         return test_err
 
 
+    ############# adaptive search ####################
+
+    def halving_search(self, model, configs, min_budget=None, max_budget=None,
+                       eta=3, resource='iters'):
+        """
+        Successive halving over a list of parameter dicts, scored on the
+        train/test split of fold 0.  All configs get min_budget, then the
+        best 1/eta are promoted to eta times the budget, until max_budget.
+
+        resource 'iters' budgets max_train_iters (default max_budget is
+        model.max_train_iters); promoted models that support it
+        (warm_startable) continue with partial_fit for the extra epochs
+        instead of retraining, which comes close to but doesn't exactly
+        match a cold run with the larger budget.  resource 'data'
+        budgets the fraction of the training reviews used (default
+        max_budget 1.0), taken as a prefix of the shuffled training rows
+        (shuffled with fold_seed, so the subsets are nested).
+
+        Returns [(attrdict, budget, test error)] for every config at the
+        last budget it reached, best first; the winner always reaches
+        max_budget.
+        """
+        if resource not in ('iters', 'data'):
+            raise ValueError("unknown resource '{}'".format(resource))
+        if max_budget is None:
+            max_budget = model.max_train_iters if resource == 'iters' else 1.
+        if min_budget is None:
+            min_budget = max_budget / float(eta**2)
+        if resource == 'iters':
+            min_budget = max(1, int(min_budget))
+        train_list, test_list = self.split(0)
+
+        alive = list(configs)
+        trained = {}
+        scores = {}
+        budget = min_budget
+        prev = 0
+        rung = 0
+        while alive:
+            t0 = time()
+            errs = []
+            for attrdict in alive:
+                key = param_key(attrdict)
+                np.random.seed(self.SEED + rung)
+                random.seed(self.SEED + rung)
+                m = trained.get(key)
+                if resource == 'iters' and m is not None:
+                    m.max_train_iters = budget - prev
+                    m.partial_fit(train_list)
+                else:
+                    m = configure(model, attrdict)
+                    if resource == 'iters':
+                        m.max_train_iters = budget
+                        m.train(train_list)
+                    else:
+                        m.train(self.budget_subset(train_list, budget))
+                if resource == 'iters' and warm_startable(m):
+                    trained[key] = m
+                err = float(m.test(test_list))
+                scores[key] = (attrdict, budget, err)
+                errs.append(err)
+            order = np.argsort(errs, kind='mergesort')
+            print "rung {}: {} configs at {} {}, best {:.4f}, time {:.2f}mins".format(
+                rung, len(alive), budget, resource, errs[order[0]], (time()-t0)/60)
+            # a lone survivor is still promoted, so it ends at max_budget
+            if budget >= max_budget:
+                break
+            keep = order[:max(1, len(alive) // eta)]
+            dropped = set(param_key(alive[i]) for i in order[len(keep):])
+            for key in dropped:
+                trained.pop(key, None)
+            alive = [alive[i] for i in keep]
+            prev = budget
+            budget = budget * eta
+            if budget >= max_budget * (1 - 1e-9):
+                # fractions of the data can fall just short of 1.0
+                budget = max_budget
+            rung += 1
+        return sorted(scores.values(), key=lambda x: (-x[1], x[2]))
+
+    def budget_subset(self, train_list, fraction):
+        n = max(1, int(round(len(train_list) * fraction)))
+        if isinstance(train_list, ReviewData):
+            # Folds rows are already in shuffled order
+            return train_list.view(0, n)
+        # KFold training indices are sorted, i.e. in db order
+        order = np.random.RandomState(self.fold_seed).permutation(len(train_list))
+        return [train_list[i] for i in order[:n]]
+
+    def hyperband_search(self, model, params, min_budget=None, max_budget=None,
+                         eta=3, resource='iters', seed=0):
+        """
+        Hyperband: successive halving brackets trading the number of
+        configs against their starting budget, from many configs at
+        about min_budget (default 1 epoch, or 1/eta^2 of the data) down
+        to a few at max_budget.  Configs are drawn at random (seeded)
+        from the grid in params.  Returns the best (attrdict, budget,
+        test error) and every bracket's results.
+        """
+        if max_budget is None:
+            max_budget = model.max_train_iters if resource == 'iters' else 1.
+        if min_budget is None:
+            min_budget = 1 if resource == 'iters' else max_budget / float(eta**2)
+        grid = list(self.attr_combs(params))
+        rng = np.random.RandomState(seed)
+        smax = int(np.log(max_budget / float(min_budget)) / np.log(eta) + 1e-9)
+        brackets = []
+        for s in range(smax, -1, -1):
+            n = int(np.ceil((smax + 1.) / (s + 1) * eta**s))
+            configs = [grid[i] for i in rng.permutation(len(grid))[:n]]
+            print "bracket {}: {} configs from budget {}".format(s, len(configs), max_budget / float(eta**s))
+            brackets.append(self.halving_search(model, configs, max_budget / float(eta**s),
+                                                max_budget, eta, resource))
+        finals = [r for results in brackets for r in results if r[1] >= max_budget]
+        best = min(finals, key=lambda x: x[2])
+        print "best: {} test error {:.4f}".format(best[0], best[2])
+        return best, brackets
+
+
+def _grid_part(attrdict):
+    state = parallel.STATE
+    wrapper = state['wrapper']
+    # workers are daemonic and can't fork fold workers of their own
+    wrapper.njobs = 1
+    return attrdict, float(wrapper.start(configure(state['model'], attrdict)))
+
+
+def _fold_part(fold):
+    state = parallel.STATE
+    return state['wrapper'].run_fold(state['model'], fold)
+
+
 def round_to_1(x):
     return round(x, -int(floor(log10(x))))
 
@@ -89,13 +556,16 @@ def run():
     
     print "reading data"
     dbname = '../data/mod_trip_advisor.db'
-    #data = Parse(dbname)
-    #pickle.dump( data, open( "tripadv.p", "wb" ) )
+    # parsed columns are cached in cache/ and memory mapped on later runs
+    data = Parse(dbname, cache_dir='cache')
+    # subsets are selected in SQLite, e.g. attractions with >= 100 reviews:
+    #create_indexes(dbname)
+    #data = Parse(dbname, cache_dir='cache',
+    #             filters={'exclude_countries': ['USA'], 'min_item_reviews': 100})
+    nusers, nitems = data.nusers, data.nitems
+    if data.date_fallbacks:
+        print "{} review dates needed dateutil".format(data.date_fallbacks)
 
-    ############# Load Data ####################
-    #print "Loading Data...."
-    #data = pickle.load(open("tripadv.p"))
-    
     #nusers = len( set( map(lambda x: x.uid, data.review_list)) )
     #nitems = len( set( map(lambda x: x.aid, data.review_list)) )
 
@@ -106,6 +576,9 @@ def run():
     #model = PlainSVD(nusers, nitems)
     #model = AidAverage()
 
+    # Neighbourhood
+    #model = ItemKNN()
+
     # Linear Models
     #model = BaseModel()
     #model = ItemModel()
@@ -132,10 +605,14 @@ def run():
     savename = 'usermodel1'
 
     model.verbose = False
-    mw = ModelWrapper(data.review_list)
-    mw.save_file = savename + '.npy'
+    mw = ModelWrapper(data.data)
+    # grid search results, appended per combination; rerun to resume
+    mw.save_file = savename + '.jsonl'
+    # CV results of every start(), so repeated experiments are instant
+    mw.cache_dir = 'cvcache'
 
     paramsearch = 0
+    adaptivesearch = 0
     singlerun = 0
     featsearch = 0
     itemmonth = 0
@@ -248,6 +725,10 @@ def run():
             json.dump(params.items(), f)
         mw.param_search(model, params)
 
+    # successive halving brackets instead of the full grid
+    if adaptivesearch:
+        mw.hyperband_search(model, {'lrate':lrates, 'reg_term':reg_terms})
+
 if __name__ == '__main__':
     run()
 